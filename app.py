@@ -1,5 +1,13 @@
 import streamlit as st
-from views import welcome, population
+from views import welcome
+from utils.instrumentation import begin_rerun, end_rerun
+
+
+@st.cache_resource
+def load_css():
+    # Read once per process rather than on every rerun
+    with open("static/css/styles.css") as f:
+        return f.read()
 
 
 def main():
@@ -11,12 +19,30 @@ def main():
         st.session_state.page = "welcome"
 
     # Apply custom CSS
-    with open("static/css/styles.css") as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+    st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
+
+    profiling = st.query_params.get("debug") == "profile"
+    begin_rerun(profiling)
+    try:
+        show_page()
+    finally:
+        rerun = end_rerun()
+
+    if profiling and rerun is not None:
+        from components.profile_panel import show_profile_panel
+        show_profile_panel(rerun)
+
+    if st.query_params.get("debug") == "memory":
+        from components.memory_panel import show_memory_panel
+        show_memory_panel()
+
 
+def show_page():
     if st.session_state.page == "welcome":
         welcome.show()
     elif st.session_state.page == "population":
+        # Imported on first visit: the population page pulls in pandas, NumPy and Plotly
+        from views import population
         population.show()
     else:
         st.write(f"Page for {st.session_state.page} is under construction.")
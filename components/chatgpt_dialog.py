@@ -1,82 +1,127 @@
+import numpy as np
+import pandas as pd
 import streamlit as st
-import time
-import random
-import threading
-from utils.openai_client import get_population_projection
+from utils.jobs import get_job_pool, QUEUED, DONE, FAILED
+from utils.openai_client import (stream_population_projection, generate_projection_batch, projection_arrays,
+                                 ProjectionError, PROJECTION_YEARS)
+from utils.instrumentation import plotly_chart
+from utils.plots import plot_population_projection
 
 def show_ui():
     if st.session_state.get('generating_projection', False):
-        show_chatgpt_dialog(st.session_state.user_prompt)
+        show_chatgpt_dialog(st.session_state.projection_job_id)
     else:
         with st.sidebar.expander("Custom Scenarios", expanded=False):
             user_prompt = st.text_area("Enter scenario details:", height=100)
+            batch = st.checkbox("One scenario per line")
             generate_button = st.button("Generate Projection")
 
+        if 'projection_error' in st.session_state:
+            st.sidebar.error(f"Failed to generate projection: {st.session_state.pop('projection_error')}")
+
         if generate_button:
             if not user_prompt:
                 st.sidebar.warning("Please enter scenario details.")
             else:
+                prompts = [line.strip() for line in user_prompt.splitlines() if line.strip()]
+                if batch and len(prompts) > 1:
+                    job = get_job_pool().submit(run_projection_batch, prompts)
+                else:
+                    job = get_job_pool().submit(run_projection, user_prompt)
                 st.session_state.generating_projection = True
-                st.session_state.user_prompt = user_prompt
+                st.session_state.projection_job_id = job.id
                 st.rerun()
 
-def show_chatgpt_dialog(user_prompt):
-    with st.spinner("Generating population projection..."):
-        progress_bar = st.progress(0)
-        year_display = st.empty()
-        status_display = st.empty()
-        thread_result = {"df": None, "completed": False, "error": None}
-
-        def api_call():
-            try:
-                thread_result["df"] = get_population_projection(user_prompt)
-            except Exception as e:
-                thread_result["error"] = str(e)
-            finally:
-                thread_result["completed"] = True
-
-        api_thread = threading.Thread(target=api_call)
-        api_thread.start()
-
-        simulate_progress(progress_bar, year_display)
-
-        api_thread.join()
-
-        if thread_result["error"]:
-            st.error(f"Failed to generate projection: {thread_result['error']}")
-        elif thread_result["df"] is not None:
-            st.session_state.generated_df = thread_result["df"]
-            year_display.success("Projection completed!")
-            progress_bar.progress(1.0)
-            time.sleep(1)
+def run_projection(job, user_prompt):
+    job.report(0.0, "Waiting for the model...")
+    records = []
+    try:
+        for record in stream_population_projection(user_prompt, should_stop=lambda: job.cancelled):
+            records.append(record)
+            job.report(len(records) / len(PROJECTION_YEARS), f"Received year {record['Year']}", partial=records)
+    except ProjectionError:
+        raise
+    except Exception as e:
+        raise ProjectionError(f"Error in API call: {str(e)}") from e
+    # Two small arrays are all a session keeps of the result
+    return projection_arrays(records), []
+
+def run_projection_batch(job, prompts):
+    # Every scenario as one line of the same chart, keyed by the start of its prompt
+    job.report(0.0, f"Generating {len(prompts)} scenarios...")
+    finished = []
+
+    def on_result(index):
+        finished.append(index)
+        job.report(len(finished) / len(prompts), f"Finished {len(finished)} of {len(prompts)} scenarios")
+
+    results = generate_projection_batch(prompts, on_result=on_result, should_stop=lambda: job.cancelled)
+    projection = {'Year': np.array(PROJECTION_YEARS, dtype=np.uint16)}
+    errors = []
+    for label, result in zip(batch_labels(prompts), results):
+        if result is None:
+            # Never sent: the job was cancelled
+            continue
+        if isinstance(result, ProjectionError):
+            errors.append(f"{label}: {result}")
         else:
-            st.error("Failed to generate projection. Please try again.")
+            projection[label] = result['Population']
+    if len(projection) == 1:
+        raise ProjectionError("; ".join(errors))
+    return projection, errors
+
+def batch_labels(prompts):
+    # The start of each prompt; prompts that start alike are told apart by their line number
+    labels = [prompt if len(prompt) <= 40 else prompt[:37] + '...' for prompt in prompts]
+    counts = {}
+    for label in labels:
+        counts[label] = counts.get(label, 0) + 1
+    return [f"{label} ({line})" if counts[label] > 1 else label for line, label in enumerate(labels, 1)]
+
+def show_chatgpt_dialog(job_id):
+    pool = get_job_pool()
+    if pool.get(job_id) is None:
+        finish_projection()
+        st.rerun()
+
+    st.markdown("### Generating population projection")
+    show_projection_progress(job_id)
+
+    if st.button("Cancel", key="cancel_projection"):
+        pool.cancel(job_id)
+        finish_projection()
+        st.rerun()
+
+@st.fragment(run_every=0.5)
+def show_projection_progress(job_id):
+    # Polls the job twice a second; only this fragment reruns while the request is in flight
+    pool = get_job_pool()
+    job = pool.get(job_id)
+
+    if job.status == QUEUED:
+        st.progress(0.0)
+        st.info(f"Waiting for a free worker ({pool.queue_position(job_id)} requests ahead)")
+    else:
+        st.progress(job.progress)
+        st.info(f"{job.message or 'Generating...'} ({job.elapsed():.0f}s)")
+
+    # Chart the years received so far; the worker keeps appending to job.partial
+    if job.partial:
+        partial_df = pd.DataFrame(list(job.partial))
+        plotly_chart('generated_projection_partial', plot_population_projection(partial_df, True, is_generated=True),
+                     use_container_width=True, config={'displayModeBar': False})
+
+    if job.finished:
+        if job.status == DONE and job.result is not None:
+            st.session_state.generated_projection, errors = job.result
+            if errors:
+                st.session_state.projection_error = "; ".join(errors)
+        elif job.status == FAILED:
+            st.session_state.projection_error = job.error
+        finish_projection()
+        st.rerun()
 
+def finish_projection():
     st.session_state.generating_projection = False
-    if 'user_prompt' in st.session_state:
-        del st.session_state.user_prompt
-    st.rerun()
-
-def simulate_progress(progress_bar, year_display):
-    start_year, end_year = 2024, 2100
-    total_years = end_year - start_year
-    base_wait = 0.4
-    max_variation = 0.1
-
-    for i in range(total_years):
-        current_year = start_year + i
-        progress = i / total_years
-        progress_bar.progress(progress)
-        year_display.info(f"Simulating year {current_year}")
-
-        wait_time = base_wait + random.uniform(0, max_variation)
-        if random.random() < 0.1:
-            wait_time += random.uniform(0.2, 0.5)
-        time.sleep(wait_time)
-
-    year_display.info("Finalizing some things...")
-    time.sleep(5)
-    year_display.info("Simulation Done!")
-    time.sleep(2)
-    year_display.info("Generating Chart...")
-    time.sleep(3)
\ No newline at end of file
+    if 'projection_job_id' in st.session_state:
+        del st.session_state.projection_job_id
@@ -19,13 +19,13 @@ def create_card(title, description, image_path, page_name):
         st.rerun()
 
 
-def sidebar_custom_slider(label, min_value, max_value, value, key, min_label, max_label):
+def sidebar_custom_slider(label, min_value, max_value, value, key, min_label, max_label, step=None):
     st.sidebar.write(label)
     col1, col2, col3 = st.sidebar.columns([2, 8, 2])
     with col1:
         st.write(min_label)
     with col2:
-        value = st.slider('', min_value, max_value, value, key=key, label_visibility='collapsed')
+        value = st.slider('', min_value, max_value, value, step=step, key=key, label_visibility='collapsed')
     with col3:
         st.write(max_label)
     return value
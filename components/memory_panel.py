@@ -0,0 +1,16 @@
+import streamlit as st
+from utils.data_processing import format_number
+from utils.memory import session_memory, server_memory
+
+
+def show_memory_panel():
+    # Opened with ?debug=memory in the URL
+    with st.sidebar.expander("Memory", expanded=True):
+        sizes = session_memory()
+        st.markdown(f"**This session:** {format_number(sum(size for _, size in sizes))}B")
+        for key, size in sizes:
+            st.text(f"{key}: {format_number(size)}B")
+
+        st.markdown("**Server**")
+        for name, size in server_memory().items():
+            st.text(f"{name}: {format_number(size)}B")
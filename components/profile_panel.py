@@ -0,0 +1,13 @@
+import streamlit as st
+from utils.openai_client import get_gateway
+
+
+def show_profile_panel(rerun):
+    # Opened with ?debug=profile in the URL; nested steps are indented under the step that ran them
+    with st.sidebar.expander("Profile", expanded=True):
+        st.markdown(f"**Rerun:** {rerun.elapsed_ms:.0f} ms")
+        for name, depth, elapsed_ms, blocks in rerun.spans:
+            st.text(f"{'  ' * depth}{name}: {elapsed_ms:.1f} ms, {blocks:+,} blocks")
+        metrics = get_gateway().metrics()
+        st.text(f"Model requests: {metrics['queued']} queued, {metrics['in_flight']} in flight, "
+                f"{metrics['retries_total']} retried, {metrics['coalesced_total']} coalesced")
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import plotly
+from utils.data_processing import ScenarioCube, filter_data, get_combination
+from utils.figure_cache import FigureCache
+from utils.comparison import compare_scenarios
+from utils.plots import plot_population_projection, plot_population_composition, plot_difference_pyramid
+from utils.sensitivity import sweep
+from utils.storage import read_csv, read_population, convert_to_columnar, ensure_store, open_store
+from utils.synthetic import generate, age_group_labels
+from views.scenario_comparison import build_comparison_projection, build_yearly_difference
+
+# The grids the sensitivity tab sweeps by default
+SENSITIVITY_ASMR = tuple(range(-5, 6))
+SENSITIVITY_ASFR = tuple(range(-5, 5))
+FIRST_YEAR = 2024
+# Offsets tried for a setting between the data's grid points; the last is finer than any synthetic grid
+OFF_GRID_STEPS = (0.5, 0.25, 0.05, 0.005, 0.0005)
+
+
+def measure(fn, repeat):
+    # The first call is reported on its own: it is what a cold rerun pays
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    warm = timings[1:] or timings
+    return {
+        'first_ms': timings[0],
+        'median_ms': statistics.median(warm),
+        'min_ms': min(warm),
+        'max_ms': max(warm),
+        'runs': repeat,
+    }
+
+
+def run_benchmarks(csv_path, repeat):
+    results = {}
+    results['load_data_csv'] = measure(lambda: read_csv(csv_path), repeat)
+    convert_to_columnar(csv_path)
+    results['load_data_parquet'] = measure(lambda: read_population(csv_path), repeat)
+
+    df = read_population(csv_path)
+    results['load_cube_frame'] = measure(lambda: ScenarioCube.from_frame(df), repeat)
+    store = ensure_store(csv_path)
+    results['load_cube_store'] = measure(lambda: open_store(store), repeat)
+
+    index, counts, totals = open_store(store)
+    cube = ScenarioCube(index['combinations'], index['years'], index['genders'], index['age_groups'], counts, totals)
+    on_grid = get_combination(1, -1) if get_combination(1, -1) in cube else cube.combinations[0]
+    results['filter_data'] = measure(lambda: filter_data(cube, on_grid), repeat)
+    # Off the grid, the first call also calibrates the projection model
+    off_grid = next((combination for combination in (get_combination(1 + step, -step) for step in OFF_GRID_STEPS)
+                     if combination not in cube), None)
+    assert off_grid is not None, "every candidate setting is on the data's grid"
+    results['filter_data_projected'] = measure(lambda: filter_data(cube, off_grid), repeat)
+
+    scenario = filter_data(cube, on_grid)
+    last_year = int(cube.years[-1])
+    results['plot_population_projection'] = measure(lambda: plot_population_projection(scenario, True), repeat)
+    results['plot_population_composition'] = measure(
+        lambda: plot_population_composition(scenario, last_year, f"Population Composition at {last_year}"), repeat)
+    results['figure_to_json'] = measure(lambda: plot_population_projection(scenario, True).to_json(), repeat)
+    # What a figure-cache hit costs instead of plot_population_projection
+    figure_cache = FigureCache()
+    figure_cache.put('projection', plot_population_projection(scenario, True))
+    results['figure_cache_hit'] = measure(lambda: figure_cache.get('projection'), repeat)
+
+    # The sensitivity tab's two views: the final-population heatmap and the impact/volatility scatter
+    end_year = min(last_year, 2100)
+    results['sensitivity_heatmap'] = measure(
+        lambda: sweep(cube, SENSITIVITY_ASMR, SENSITIVITY_ASFR, metrics=('final_population',),
+                      start_year=FIRST_YEAR, end_year=end_year), repeat)
+    results['sensitivity_scatter'] = measure(
+        lambda: sweep(cube, SENSITIVITY_ASMR, SENSITIVITY_ASFR, metrics=('impact', 'volatility'),
+                      start_year=FIRST_YEAR, end_year=end_year), repeat)
+
+    other = cube.combinations[-1]
+
+    def comparison():
+        # show_comparison_mode without Streamlit or the figure cache
+        comparison = compare_scenarios(cube, [on_grid, other])
+        build_comparison_projection(comparison)
+        plot_population_composition(comparison.view(0), last_year, "Scenario 1")
+        plot_population_composition(comparison.view(1), last_year, "Scenario 2")
+        build_yearly_difference(comparison, False)
+        plot_difference_pyramid(comparison, 1, last_year, "Scenario 2 vs Scenario 1")
+    results['comparison'] = measure(comparison, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Benchmarks whose median got slower than the baseline's by more than the tolerance
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before and result['median_ms'] > before['median_ms'] * (1 + tolerance):
+            regressions.append((name, before['median_ms'], result['median_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the app's data, aggregation and figure-building paths.")
+    parser.add_argument('--combinations', type=int, default=111)
+    parser.add_argument('--years', type=int, default=77)
+    parser.add_argument('--age-width', type=int, default=5, help="years per age group; 1 for single years")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', dest='json_path', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'population_composition.csv')
+        generate(csv_path, args.combinations, range(FIRST_YEAR, FIRST_YEAR + args.years), args.age_width,
+                 formats=('csv',))
+        results = run_benchmarks(csv_path, max(1, args.repeat))
+
+    report = {
+        'dataset': {'combinations': args.combinations, 'years': args.years,
+                    'age_groups': len(age_group_labels(args.age_width))},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'plotly': plotly.__version__, 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    for name, result in results.items():
+        print(f"{name:30} first {result['first_ms']:9.1f} ms   median {result['median_ms']:9.1f} ms")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('dataset') != report['dataset']:
+            print("Warning: the baseline was run on a different dataset")
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print(f"Regression: {name} {before:.1f} ms -> {after:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # python -m utils.benchmark [--combinations 1000] [--json results.json] [--baseline previous.json]
+    main()
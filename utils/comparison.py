@@ -0,0 +1,76 @@
+import numpy as np
+from utils.data_processing import ScenarioView, parse_combination
+from utils.instrumentation import instrumented
+
+
+class ScenarioComparison:
+    # N scenarios stacked into one (scenario, year, gender, age group) array, with their yearly totals.
+    # Differences are taken against the reference scenario (the first, unless told otherwise).
+    def __init__(self, cube, combinations, counts, totals, reference=0):
+        self.cube = cube
+        self.combinations = list(combinations)
+        self.counts = counts
+        self.totals = totals
+        self.reference = reference
+
+    @property
+    def years(self):
+        return self.cube.years
+
+    @property
+    def age_groups(self):
+        return self.cube.age_groups
+
+    def view(self, index):
+        # One scenario as the single-view plots expect it, without recomputing anything
+        return ScenarioView(self.cube, self.combinations[index], self.counts[index], self.totals[index])
+
+    def yearly_difference(self, relative=False):
+        # (scenario, year): each scenario's total minus the reference's, or that as a fraction of it
+        difference = self.totals - self.totals[self.reference]
+        return relative_to(difference, self.totals[self.reference]) if relative else difference
+
+    def age_difference(self, year, relative=False):
+        # (scenario, gender, age group) in one year
+        counts = self.counts[:, self.cube.year_index[year]]
+        difference = counts - counts[self.reference]
+        return relative_to(difference, counts[self.reference]) if relative else difference
+
+    def pyramid_difference(self, year, gender, relative=False):
+        # (scenario, age group): one side of each scenario's difference pyramid
+        return self.age_difference(year, relative)[:, self.cube.gender_index[gender]]
+
+
+def relative_to(difference, base):
+    # Empty cells in the reference have no relative difference
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(base != 0, difference / base, np.nan)
+
+
+@instrumented('compare_scenarios')
+def compare_scenarios(cube, combinations, reference=0):
+    # Scenarios in the data are gathered with one indexing of the cube and keep its precomputed totals;
+    # the others are projected together in one batch. Named scenarios must be in the data.
+    combinations = list(combinations)
+    counts = np.empty((len(combinations),) + cube.counts.shape[1:])
+    totals = np.empty((len(combinations), len(cube.years)))
+
+    stored = [i for i, combination in enumerate(combinations) if combination in cube]
+    if stored:
+        indices = [cube.combination_index[combinations[i]] for i in stored]
+        counts[stored] = cube.counts[indices]
+        totals[stored] = cube.totals[indices]
+
+    projected = [i for i in range(len(combinations)) if combinations[i] not in cube]
+    if projected:
+        adjustments = [parse_combination(combinations[i]) for i in projected]
+        missing = [combinations[i] for i, adjustment in zip(projected, adjustments) if adjustment is None]
+        if missing:
+            raise KeyError(missing[0])
+        asmr, asfr = np.array(adjustments).T
+        counts[projected] = cube.projection_model().project_anchored(asmr, asfr)
+        totals[projected] = counts[projected].sum(axis=(2, 3))
+
+    counts.flags.writeable = False
+    totals.flags.writeable = False
+    return ScenarioComparison(cube, combinations, counts, totals, reference)
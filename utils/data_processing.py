@@ -1,18 +1,169 @@
+import os
+import re
+import numpy as np
 import pandas as pd
 import streamlit as st
+from utils.instrumentation import instrumented
+from utils.storage import columnar_path, read_population, store_path, ensure_store, open_store
 
+DATA_PATH = "data/population_composition.csv"
+COMBINATION_PATTERN = re.compile(r'asmr_(-?\d+(?:\.\d+)?)_asfr_(-?\d+(?:\.\d+)?)$')
 
-@st.cache_data
+
+@instrumented('load_data')
 def load_data():
-    return pd.read_csv("data/population_composition.csv")
+    return _load_data(data_file_key())
+
+
+@st.cache_resource(max_entries=1)
+def _load_data(data_key):
+    # data_key changes whenever the file on disk does, which invalidates the cached frame.
+    # One frame is shared by every session, so its arrays are frozen rather than copied per call
+    return read_only_frame(read_population(DATA_PATH))
+
+
+def read_only_frame(df):
+    columns = {}
+    for name, column in df.items():
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes = column.cat.codes.to_numpy(copy=True)
+            codes.flags.writeable = False
+            columns[name] = pd.Categorical.from_codes(codes, dtype=column.dtype)
+        else:
+            values = column.to_numpy(copy=True)
+            values.flags.writeable = False
+            columns[name] = values
+    # copy=False keeps each frozen array as its own block instead of consolidating them into a new one
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+class ScenarioCube:
+    # Dense population counts indexed by (combination, year, gender, age group).
+    # Labels are integer-coded once so lookups never scan the rows again.
+    def __init__(self, combinations, years, genders, age_groups, counts, totals=None):
+        self.combinations = list(combinations)
+        self.years = np.asarray(years)
+        self.genders = list(genders)
+        self.age_groups = list(age_groups)
+        self.counts = counts
+
+        # Yearly totals for every combination are aggregated once at load time;
+        # the per-year gender/age pyramids are already laid out in counts
+        if totals is None:
+            totals = counts.sum(axis=(2, 3))
+            totals.flags.writeable = False
+        self.totals = totals
+        self.combination_index = {c: i for i, c in enumerate(self.combinations)}
+        self.year_index = {int(y): i for i, y in enumerate(self.years)}
+        self.gender_index = {g: i for i, g in enumerate(self.genders)}
+        self._projection_model = None
+
+    @classmethod
+    def from_frame(cls, df):
+        # Combinations keep their order of appearance (as df['Combination'].unique() did),
+        # the other axes are sorted the way the plots used to sort them
+        comb_codes, combinations = pd.factorize(df['Combination'])
+        year_codes, years = pd.factorize(df['Year'], sort=True)
+        gender_codes, genders = pd.factorize(df['Gender'], sort=True)
+        age_codes, age_groups = pd.factorize(df['AgeGroup'], sort=True)
+
+        counts = np.zeros((len(combinations), len(years), len(genders), len(age_groups)))
+        np.add.at(counts, (comb_codes, year_codes, gender_codes, age_codes), df['Count'].to_numpy(dtype=float))
+        counts.flags.writeable = False
+        return cls(combinations, years, genders, age_groups, counts)
+
+    def __contains__(self, combination):
+        return combination in self.combination_index
+
+    def scenario(self, combination):
+        index = self.combination_index.get(combination)
+        if index is not None:
+            return ScenarioView(self, combination, self.counts[index], self.totals[index])
+
+        # Slider settings outside the precomputed grid are projected from rates
+        adjustments = parse_combination(combination)
+        if adjustments is None:
+            raise KeyError(combination)
+        counts = self.projection_model().project_anchored(*adjustments)
+        return ScenarioView(self, combination, counts, counts.sum(axis=(1, 2)))
+
+    def projection_model(self):
+        # Calibrated against the baseline on first use and kept with the cube
+        if self._projection_model is None:
+            from utils.projection import CohortComponentModel
+            self._projection_model = CohortComponentModel.from_cube(self)
+        return self._projection_model
+
 
+class ScenarioView:
+    # Read-only window onto one combination of a ScenarioCube; slicing never copies
+    def __init__(self, cube, combination, counts, totals):
+        self.cube = cube
+        self.combination = combination
+        self.counts = counts
+        self.totals = totals
 
-def filter_data(df, comb):
-    return df[df['Combination'] == comb]
+    @property
+    def years(self):
+        return self.cube.years
+
+    @property
+    def age_groups(self):
+        return self.cube.age_groups
+
+    def year(self, year):
+        return self.counts[self.cube.year_index[year]]
+
+    def pyramid(self, year, gender):
+        return self.counts[self.cube.year_index[year], self.cube.gender_index[gender]]
+
+    def yearly_totals(self):
+        return self.totals
+
+
+@instrumented('load_cube')
+def load_cube():
+    return _load_cube(data_file_key())
+
+
+@st.cache_resource(max_entries=1)
+def _load_cube(data_key):
+    # Prefer the memory-mapped store, which pages in only the scenarios that are read;
+    # build the cube in memory if the store can't be written or opened
+    try:
+        index, counts, totals = open_store(ensure_store(DATA_PATH))
+    except (OSError, ValueError):
+        return ScenarioCube.from_frame(load_data())
+    return ScenarioCube(index['combinations'], index['years'], index['genders'], index['age_groups'], counts, totals)
+
+
+def data_file_key(path=DATA_PATH):
+    # Identity of the data file on disk, used to key caches derived from it.
+    # Deployments may ship only the columnar copy or the store, so fall back to those.
+    for candidate in (path, columnar_path(path), os.path.join(store_path(path), 'index.json')):
+        if os.path.exists(candidate):
+            path = candidate
+            break
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+@instrumented('filter_data')
+def filter_data(cube, comb):
+    return cube.scenario(comb)
 
 
 def get_combination(asmr, asfr):
-    return f"asmr_{-asmr}_asfr_{-asfr}"
+    # 0 - x rather than -x so a zero slider never formats as "-0"
+    return f"asmr_{0 - asmr:g}_asfr_{0 - asfr:g}"
+
+
+def parse_combination(comb):
+    # Inverse of get_combination: the (asmr, asfr) slider values, or None for named scenarios
+    match = COMBINATION_PATTERN.match(comb)
+    if match is None:
+        return None
+    return 0 - float(match.group(1)), 0 - float(match.group(2))
 
 
 def format_number(num):
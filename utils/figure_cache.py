@@ -0,0 +1,86 @@
+import json
+import threading
+from collections import OrderedDict
+import plotly.graph_objects as go
+import streamlit as st
+from utils.data_processing import data_file_key
+
+FIGURE_CACHE_SIZE = 512
+
+
+class FigureCache:
+    # Size-bounded LRU of serialized figure JSON, shared by every session in the process
+    def __init__(self, max_entries=FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            spec = self._entries.get(key)
+            if spec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # The spec was validated when the figure was built, so it is not validated again; a fresh
+        # parse per hit means no two sessions share the figure's dicts
+        return go.Figure(json.loads(spec), _validate=False)
+
+    def put(self, key, fig):
+        spec = fig.to_json()
+        with self._lock:
+            self._entries[key] = spec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        fig = self.get(key)
+        if fig is None:
+            fig = build()
+            self.put(key, fig)
+        return fig
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+def get_figure_cache():
+    return _figure_cache(data_file_key())
+
+
+@st.cache_resource(max_entries=1)
+def _figure_cache(data_key):
+    # One cache per data file, so replaced data never serves old figures
+    return FigureCache()
+
+
+def current_theme():
+    return st.get_option("theme.base") or "default"
+
+
+def figure_key(chart, combination, year=None, variant=None):
+    return chart, combination, year, current_theme(), variant
+
+
+def cached_figure(chart, combination, build, year=None, variant=None):
+    return get_figure_cache().get_or_build(figure_key(chart, combination, year, variant), build)
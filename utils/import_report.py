@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+# Entry points worth watching: what every page pays, and what the population page adds on top
+DEFAULT_MODULES = ['app', 'views.population']
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure(module):
+    # A fresh interpreter per module, so nothing is already imported
+    root = os.path.join(os.path.dirname(__file__), '..')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append({
+                'module': name,
+                'self_ms': int(self_us) / 1000,
+                'cumulative_ms': int(cumulative_us) / 1000,
+                'depth': (len(indent) - 1) // 2,
+            })
+
+    # Interpreter startup (site, encodings) sits at depth 0 next to the entry module and is left out
+    entry = next(item for item in imports if item['module'] == module)
+    # Packages are reported by their root, whose cumulative time includes all their submodules
+    packages = [item for item in imports if '.' not in item['module'] and item['depth'] > 0]
+    return {
+        'module': module,
+        'total_ms': entry['cumulative_ms'],
+        'slowest': sorted(packages, key=lambda item: item['cumulative_ms'], reverse=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how long the app's entry modules take to import.")
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=10, help="slowest packages to list per module")
+    parser.add_argument('--json', dest='json_path', help="also write the report to this file")
+    parser.add_argument('--budget-ms', type=float, help="exit non-zero if any module takes longer than this")
+    args = parser.parse_args()
+
+    reports = [measure(module) for module in args.modules]
+    for report in reports:
+        print(f"{report['module']}: {report['total_ms']:.1f} ms")
+        for item in report['slowest'][:args.top]:
+            print(f"  {item['cumulative_ms']:9.1f} ms  {item['module']}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(reports, file, indent=2)
+
+    if args.budget_ms is not None:
+        over = [report['module'] for report in reports if report['total_ms'] > args.budget_ms]
+        if over:
+            print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # python -m utils.import_report [modules...] [--json report.json] [--budget-ms 1500]
+    main()
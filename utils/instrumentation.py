@@ -0,0 +1,142 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import streamlit as st
+
+# Record every rerun, not only those opened with ?debug=profile
+ALWAYS_ENABLED = os.environ.get('POPULATION_INSTRUMENTATION') == '1'
+# Where finished reruns are exported: '.prom' files are written in Prometheus text format
+# (for a node_exporter textfile collector), anything else gets one JSON line per rerun
+METRICS_PATH = os.environ.get('POPULATION_METRICS_PATH')
+
+# Each session's script runs on its own thread, so a rerun's spans are kept per thread
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+_export_lock = threading.Lock()
+# Functions returning {metric name: value} for state other modules keep, read at each export
+_gauges = []
+
+
+class Rerun:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.elapsed_ms = None
+
+
+def begin_rerun(enabled):
+    _local.rerun = Rerun() if enabled or ALWAYS_ENABLED else None
+
+
+def end_rerun():
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        return None
+    # Fragment reruns that follow on this thread are not recorded
+    _local.rerun = None
+    rerun.elapsed_ms = (time.perf_counter() - rerun.started) * 1000
+    rerun.spans = [item for item in rerun.spans if item is not None]
+    with _totals_lock:
+        for name, _, elapsed_ms, blocks in rerun.spans + [('rerun', 0, rerun.elapsed_ms, 0)]:
+            count, total_ms, total_blocks = _totals.get(name, (0, 0.0, 0))
+            _totals[name] = (count + 1, total_ms + elapsed_ms, total_blocks + blocks)
+    if METRICS_PATH:
+        with _export_lock:
+            export(rerun)
+    return rerun
+
+
+@contextmanager
+def span(name):
+    # Wall time and the change in allocated memory blocks (a process-wide count) of the body
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        yield
+        return
+    index = len(rerun.spans)
+    rerun.spans.append(None)
+    rerun.depth += 1
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        rerun.depth -= 1
+        rerun.spans[index] = (name, rerun.depth, (time.perf_counter() - start) * 1000,
+                              sys.getallocatedblocks() - blocks)
+
+
+def instrumented(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Disabled, this is one attribute lookup on top of the call
+            if getattr(_local, 'rerun', None) is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def plotly_chart(name, fig, **kwargs):
+    # st.plotly_chart, timed: shrinking large figures and serialising them into the page happen here
+    # Imported here: rendering needs NumPy, which the welcome page does not load
+    from utils.rendering import prepare_figure
+    with span(f"chart:{name}"):
+        return st.plotly_chart(prepare_figure(fig), **kwargs)
+
+
+def register_gauges(fn):
+    _gauges.append(fn)
+
+
+def prometheus_text():
+    with _totals_lock:
+        totals = dict(_totals)
+    lines = [
+        '# HELP population_span_seconds_total Wall time spent in instrumented steps.',
+        '# TYPE population_span_seconds_total counter',
+    ]
+    lines += [f'population_span_seconds_total{{step="{name}"}} {total_ms / 1000:.6f}'
+              for name, (_, total_ms, _) in sorted(totals.items())]
+    lines += ['# HELP population_span_calls_total Calls of instrumented steps.',
+              '# TYPE population_span_calls_total counter']
+    lines += [f'population_span_calls_total{{step="{name}"}} {count}'
+              for name, (count, _, _) in sorted(totals.items())]
+    lines += ['# HELP population_span_blocks_total Memory blocks allocated in instrumented steps.',
+              '# TYPE population_span_blocks_total counter']
+    lines += [f'population_span_blocks_total{{step="{name}"}} {blocks}'
+              for name, (_, _, blocks) in sorted(totals.items())]
+    for fn in _gauges:
+        for name, value in sorted(fn().items()):
+            lines += [f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def export(rerun):
+    try:
+        if METRICS_PATH.endswith('.prom'):
+            # Swapped in whole, so the collector never reads a partial file
+            tmp_path = f"{METRICS_PATH}.tmp-{threading.get_ident()}"
+            with open(tmp_path, 'w') as file:
+                file.write(prometheus_text())
+            os.replace(tmp_path, METRICS_PATH)
+        else:
+            record = {
+                'time': time.time(),
+                'rerun_ms': rerun.elapsed_ms,
+                'spans': [{'name': name, 'depth': depth, 'ms': elapsed_ms, 'blocks': blocks}
+                          for name, depth, elapsed_ms, blocks in rerun.spans],
+            }
+            with open(METRICS_PATH, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+    except OSError:
+        # Metrics are best effort; the page must not fail because of them
+        pass
@@ -0,0 +1,131 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+
+LLM_WORKERS = 4
+# Finished jobs are kept this long so the session that submitted them can collect the result
+JOB_RETENTION_SECONDS = 600
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+
+class Job:
+    # State of one background task; updated by the worker, polled by the page
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = None
+        self.result = None
+        self.partial = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._future = None
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def elapsed(self):
+        end = self.finished_at or time.monotonic()
+        return end - (self.started_at or self.submitted_at)
+
+    def report(self, progress, message=None, partial=None):
+        # partial is whatever part of the result the page may show before the job finishes
+        self.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        if partial is not None:
+            self.partial = partial
+
+
+class JobPool:
+    # Bounded worker pool: clicks queue up behind max_workers instead of each starting a thread
+    def __init__(self, max_workers=LLM_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobs')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        # fn receives the Job first, so it can report progress and check for cancellation
+        job = Job(uuid.uuid4().hex)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            job._future = self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return
+            job._cancel_event.set()
+            # A running job notices the event itself and ends as cancelled when its call returns
+            if job._future.cancel():
+                self._finish(job, CANCELLED)
+
+    def queue_position(self, job_id):
+        with self._lock:
+            queued = [job.id for job in self._jobs.values() if job.status == QUEUED]
+        return queued.index(job_id) if job_id in queued else 0
+
+    def _run(self, job, fn, args):
+        if job.cancelled:
+            # Cancelled after it was handed to a worker, too late for the future to be cancelled
+            with self._lock:
+                self._finish(job, CANCELLED)
+            return
+        job.status = RUNNING
+        job.started_at = time.monotonic()
+        try:
+            result = fn(job, *args)
+        except Exception as e:
+            with self._lock:
+                # A call that fails because it was cancelled ends as cancelled
+                if job.cancelled:
+                    self._finish(job, CANCELLED)
+                else:
+                    job.error = str(e)
+                    self._finish(job, FAILED)
+        else:
+            with self._lock:
+                # A cancelled job may still have finished its call; its result is discarded
+                if job.cancelled:
+                    self._finish(job, CANCELLED)
+                else:
+                    job.result = result
+                    job.progress = 1.0
+                    self._finish(job, DONE)
+
+    @staticmethod
+    def _finish(job, status):
+        # Called with the lock held. finished_at goes first: once the status says finished,
+        # _prune may read it
+        job.finished_at = time.monotonic()
+        job.status = status
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > JOB_RETENTION_SECONDS:
+                del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_job_pool():
+    return JobPool()
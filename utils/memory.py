@@ -0,0 +1,36 @@
+import resource
+import sys
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime import Runtime
+
+
+def value_size(value):
+    # Bytes held by one session_state value; arrays and frames report their buffers
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(item) for item in value)
+    # Lazy-load the vendored sizer, as Streamlit does for its own stats
+    from streamlit.vendor.pympler.asizeof import asizeof
+    return asizeof(value)
+
+
+def session_memory():
+    # (key, bytes) for the current session, largest first
+    sizes = [(str(key), value_size(st.session_state[key])) for key in st.session_state]
+    return sorted(sizes, key=lambda item: item[1], reverse=True)
+
+
+def server_memory():
+    # Process-wide view: peak RSS plus what Streamlit's caches and all sessions' state hold
+    report = {'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    if Runtime.exists():
+        for stat in Runtime.instance().stats_mgr.get_stats():
+            report[stat.category_name] = report.get(stat.category_name, 0) + stat.byte_length
+    return report
@@ -0,0 +1,128 @@
+import argparse
+import sys
+import numpy as np
+
+# One byte per field: three bytes per simulated person
+AGENT_DTYPE = np.dtype([('group', np.uint8), ('gender', np.uint8), ('alive', np.bool_)])
+CHUNK_SIZE = 1_000_000
+CONFIDENCE = 0.95
+# What the projection chart's uncertainty band runs by default
+UNCERTAINTY_AGENTS = 20_000
+UNCERTAINTY_REPLICATIONS = 20
+# The band is drawn around the projection, so it must contain it in at least this share of years
+MIN_BAND_COVERAGE = 0.9
+# Slider settings the band check runs: the baseline, the grid's corners and one between grid points
+BAND_CHECK_SETTINGS = ((0, 0), (-5, -5), (-5, 4), (5, -5), (5, 4), (1.5, -0.5))
+
+
+class MicrosimResult:
+    # Per-replication counts plus the summary the projection chart needs
+    def __init__(self, years, counts, confidence=CONFIDENCE):
+        self.years = years
+        self.counts = counts
+        self.totals = counts.sum(axis=(2, 3))
+        tail = (1 - confidence) / 2
+        self.mean = self.totals.mean(axis=0)
+        self.lower, self.upper = np.quantile(self.totals, [tail, 1 - tail], axis=0)
+
+    def coverage(self, line):
+        # Share of years in which the band contains line, e.g. the projection's yearly totals
+        return float(((self.lower <= line) & (line <= self.upper)).mean())
+
+
+class AgentSimulator:
+    # Individual-level Monte Carlo version of a CohortComponentModel: the same rates, applied as
+    # random births, moves up an age group and deaths to agents. Every step is the engine's with
+    # its shares turned into probabilities, so a replication's expected counts are the engine's.
+    # Replications are scaled like the projection they are drawn around: by the model's correction
+    # and by its anchor to the data.
+    def __init__(self, model):
+        self.model = model
+
+    def run_replication(self, asmr, asfr, n_agents, seed, chunk_size=CHUNK_SIZE):
+        # Agents never interact, so the population is simulated as independent chunks one after
+        # another: memory stays at one chunk however many agents are requested
+        mortality_multiplier, fertility_multiplier = self.model.multipliers(asmr, asfr)
+        survival = np.clip(1.0 - (1.0 - self.model.survival) * mortality_multiplier[0], 0.0, 1.0)
+        fertility = self.model.fertility * fertility_multiplier[0]
+
+        base = self.model.base_population
+        weight = base.sum() / n_agents
+        counts = np.zeros((len(self.model.years),) + base.shape)
+        chunk_sizes = [min(chunk_size, n_agents - start) for start in range(0, n_agents, chunk_size)]
+        seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        for chunk_seed, size in zip(seed.spawn(len(chunk_sizes)), chunk_sizes):
+            counts += self._simulate_chunk(np.random.default_rng(chunk_seed), size, survival, fertility)
+
+        counts *= weight
+        if self.model.correction is not None:
+            counts *= self.model.correction
+        counts = counts[..., self.model.output_order]
+        anchor = self.model.anchor_factor(asmr, asfr)
+        return counts if anchor is None else counts * anchor[0]
+
+    def simulate(self, asmr=0.0, asfr=0.0, n_agents=100_000, replications=20, seed=0, chunk_size=CHUNK_SIZE):
+        seeds = np.random.SeedSequence(seed).spawn(replications)
+        counts = np.stack([self.run_replication(asmr, asfr, n_agents, s, chunk_size) for s in seeds])
+        return MicrosimResult(self.model.years, counts)
+
+    def _simulate_chunk(self, rng, size, survival, fertility):
+        model = self.model
+        genders, groups = model.base_population.shape
+        counts = np.zeros((len(model.years), genders, groups))
+
+        # Initial agents drawn from the base pyramid
+        cell = rng.choice(genders * groups, size=size, p=(model.base_population / model.base_population.sum()).ravel())
+        agents = np.empty(size, dtype=AGENT_DTYPE)
+        agents['gender'], agents['group'] = np.divmod(cell, groups)
+        agents['alive'] = True
+        counts[0] = self._count(agents, genders, groups)
+
+        for t in range(1, len(model.years)):
+            # Births come from this year's mothers. Everyone then moves up a group with the engine's
+            # 1/width chance, newborns join the first group, and all of them survive or not.
+            mother_rate = np.where(agents['gender'] == model.female, fertility[agents['group']], 0.0)
+            n_births = int(rng.poisson(mother_rate).sum())
+            newborns = np.zeros(n_births, dtype=AGENT_DTYPE)
+            newborns['gender'] = rng.choice(genders, size=n_births, p=model.birth_shares)
+
+            agents['group'] += rng.random(len(agents)) < model.move[agents['group']]
+            agents = np.concatenate([agents, newborns])
+            survives = survival[agents['gender'], agents['group']]
+            agents['alive'] = rng.random(len(agents)) < survives
+            agents = agents[agents['alive']]
+            counts[t] = self._count(agents, genders, groups)
+        return counts
+
+    def _count(self, agents, genders, groups):
+        cells = agents['gender'].astype(np.intp) * groups + agents['group']
+        return np.bincount(cells, minlength=genders * groups).reshape(genders, groups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the uncertainty band brackets the projection it is drawn around.")
+    parser.add_argument('path', nargs='?', default='data/population_composition.csv')
+    parser.add_argument('--agents', type=int, default=UNCERTAINTY_AGENTS)
+    parser.add_argument('--replications', type=int, default=UNCERTAINTY_REPLICATIONS)
+    args = parser.parse_args()
+
+    from utils.data_processing import ScenarioCube, get_combination
+    from utils.storage import ensure_store, open_store
+    index, counts, totals = open_store(ensure_store(args.path))
+    cube = ScenarioCube(index['combinations'], index['years'], index['genders'], index['age_groups'], counts, totals)
+    simulator = AgentSimulator(cube.projection_model())
+    failed = False
+    for asmr, asfr in BAND_CHECK_SETTINGS:
+        line = cube.scenario(get_combination(asmr, asfr)).totals
+        result = simulator.simulate(asmr, asfr, args.agents, args.replications)
+        coverage = result.coverage(line)
+        failed |= coverage < MIN_BAND_COVERAGE
+        print(f"asmr {asmr:5g} asfr {asfr:5g}: band contains the projection in {coverage:.0%} of years, "
+              f"final mean / projection {result.mean[-1] / line[-1]:.3f}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # python -m utils.microsim [path/to/population_composition.csv] [--agents 20000] [--replications 20]
+    main()
@@ -1,30 +1,49 @@
+import asyncio
+import functools
+import hashlib
 import json
+import random
 import re
-import pandas as pd
-import streamlit as st
-from openai import OpenAI
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import asynccontextmanager, contextmanager
+import numpy as np
 import yaml
 import os
+from utils.instrumentation import register_gauges
 
 
+@functools.lru_cache(maxsize=None)
 def load_config():
+    # Read once per process, on first use
     config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
     with open(config_path, 'r') as file:
         config = yaml.safe_load(file)
     return config
 
 
-config = load_config()
-client = OpenAI(api_key=config['openai_api_key'])
+@functools.lru_cache(maxsize=None)
+def get_client():
+    # The openai package is slow to import, so neither it nor the client load until a request is made
+    # One pooled HTTP client for every session; retries are left to the gateway
+    import httpx
+    from openai import OpenAI, DefaultHttpxClient
+    limits = httpx.Limits(max_connections=get_gateway().max_in_flight,
+                          max_keepalive_connections=get_gateway().max_in_flight)
+    return OpenAI(api_key=load_config()['openai_api_key'], base_url=load_config().get('openai_base_url'),
+                  max_retries=0, http_client=DefaultHttpxClient(limits=limits))
 
 
-def get_population_projection(prompt):
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system",
-                 "content": """
+def get_async_client():
+    # One per batch: an async client belongs to the event loop it was first used on.
+    # openai_base_url in config.yaml points both clients at another server, e.g. a local mock
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=load_config()['openai_api_key'], base_url=load_config().get('openai_base_url'),
+                       max_retries=0)
+
+SYSTEM_PROMPT = """
                  You are an AI that generates population projection data for Saudi Arabia.
                  Respond with a JSON string containing a list of dictionaries, each with 'Year' and 'Population' keys.
                  The 'Population' key must be number that starts at 19 million in 2024.
@@ -108,27 +127,570 @@ def get_population_projection(prompt):
                 2098  30325330
                 2099  30321150
                 2100  30023040
-                 """},
-                {"role": "user",
-                 "content": f"Generate a population projection from 2024 to 2100 based on this scenario: {prompt}"}
-            ]
-        )
-        res = response.choices[0].message.content
-        json_str = re.sub(r'```json\s*|\s*```', '', res)
-        data = json.loads(json_str)
-
-        if not isinstance(data, list) or not all(
-                isinstance(item, dict) and 'Year' in item and 'Population' in item for item in data):
-            raise ValueError("Invalid data structure in API response")
-
-        return pd.DataFrame(data)
-
-    except json.JSONDecodeError as e:
-        st.error(f"Error decoding JSON: {str(e)}")
-        st.error(f"Raw response: {json_str}")
-    except ValueError as e:
-        st.error(f"Error in data structure: {str(e)}")
-    except Exception as e:
-        st.error(f"Error in API call: {str(e)}")
-
-    return None
\ No newline at end of file
+                 """
+
+
+MODEL = "gpt-4-turbo"
+PROJECTION_YEARS = range(2024, 2101)
+# The baseline table the prompts are written around, parsed once from the system prompt
+BASELINE_POPULATION = np.array([int(population) for _, population in
+                                re.findall(r'^\s*(\d{4})\s+(\d+)\s*$', SYSTEM_PROMPT, re.MULTILINE)], dtype=float)
+
+# Batches send the baseline once as a compact list and get back one percentage per year
+BATCH_SYSTEM_PROMPT = (
+    "You alter population projections for Saudi Arabia. The baseline population in thousands for each year "
+    f"from {PROJECTION_YEARS[0]} to {PROJECTION_YEARS[-1]} is: "
+    + ",".join(f"{population / 1000:.0f}" for population in BASELINE_POPULATION)
+    + f". Reply with a JSON object {{\"delta_percent\": [...]}} holding exactly {len(PROJECTION_YEARS)} numbers: "
+    f"the scenario's percentage difference from the baseline in each year, starting with 0 for {PROJECTION_YEARS[0]}. "
+    "Use at most one decimal place and no other keys."
+)
+BATCH_CONCURRENCY = 8
+# Deltas outside this range (in percent) are treated as a malformed answer
+DELTA_LIMITS = (-90.0, 400.0)
+
+CACHE_PATH = os.path.join(os.path.dirname(__file__), '..', '.cache', 'llm_projections.sqlite')
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 1000
+
+# Gateway defaults; openai_requests_per_minute and openai_max_in_flight in config.yaml override them
+REQUESTS_PER_MINUTE = 120
+REQUEST_BURST = 10
+MAX_IN_FLIGHT = 16
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20.0
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# How often waiting async requests look for a free slot, and waiting callers check should_stop
+POLL_SECONDS = 0.05
+
+
+class ProjectionError(Exception):
+    pass
+
+
+def projection_messages(prompt):
+    return [
+        {"role": "system",
+         "content": SYSTEM_PROMPT},
+        {"role": "user",
+         "content": f"Generate a population projection from 2024 to 2100 based on this scenario: {prompt}"}
+    ]
+
+
+class ProjectionCache:
+    # On-disk cache of generated projections, shared by every session and kept across restarts.
+    # Entries are addressed by a hash of the normalized prompt, the model and the system prompt.
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS projections (
+                    key TEXT PRIMARY KEY,
+                    records TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        # One short-lived connection per call keeps this safe to use from worker threads
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @staticmethod
+    def key(prompt, model=MODEL, system_prompt=SYSTEM_PROMPT):
+        normalized = ' '.join(prompt.split()).casefold()
+        payload = json.dumps([normalized, model, system_prompt])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, prompt, model=MODEL, system_prompt=SYSTEM_PROMPT):
+        key = self.key(prompt, model, system_prompt)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT records, created_at FROM projections WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM projections WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE projections SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, prompt, records, model=MODEL, system_prompt=SYSTEM_PROMPT):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO projections VALUES (?, ?, ?, ?)",
+                         (self.key(prompt, model, system_prompt), json.dumps(records), now, now))
+            # Drop expired entries, then the least recently used beyond the size limit
+            conn.execute("DELETE FROM projections WHERE created_at < ?", (now - self.ttl,))
+            conn.execute("""
+                DELETE FROM projections WHERE key NOT IN (
+                    SELECT key FROM projections ORDER BY accessed_at DESC LIMIT ?
+                )
+            """, (self.max_entries,))
+
+
+@functools.lru_cache(maxsize=None)
+def get_projection_cache():
+    return ProjectionCache()
+
+
+class FlightCancelled(Exception):
+    # A caller gave up (its should_stop() turned true) before its request finished; if it was leading,
+    # one of its followers takes over
+    pass
+
+
+class TokenBucket:
+    # rate tokens a second, up to capacity saved up for bursts. A reservation may take the bucket
+    # below zero: the caller waits the debt out, so waiting requests go out in arrival order.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Seconds to wait before the request may be sent
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class OpenAIGateway:
+    # Every model request in the process goes through here, whichever session and thread it comes from.
+    # Identical requests in flight together are sent once and share the answer (single flight); each
+    # attempt takes a token from the rate limiter and one of max_in_flight slots; rate limits and
+    # transient failures are retried with jittered exponential backoff.
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, burst=REQUEST_BURST, max_in_flight=MAX_IN_FLIGHT,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE_SECONDS, backoff_cap=BACKOFF_CAP_SECONDS):
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(['queued', 'in_flight', 'requests_total', 'retries_total',
+                                      'coalesced_total', 'failures_total'], 0)
+
+    def _count(self, name, change=1):
+        with self._lock:
+            self._counts[name] += change
+
+    def metrics(self):
+        # queued: waiting for a token or a slot; in_flight: being answered; flights: distinct requests open
+        with self._lock:
+            return dict(self._counts, flights=len(self._flights))
+
+    def join(self, key):
+        # (future, leader): the first caller for a key leads and must finish() it; the rest wait on the future
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self._counts['coalesced_total'] += 1
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            future = self._flights.pop(key)
+        if error is None:
+            future.set_result(result)
+        else:
+            # Followers only see failures of the request itself; an interrupted leader hands over
+            future.set_exception(error if isinstance(error, Exception) else FlightCancelled())
+
+    def wait(self, future, should_stop=None):
+        # A follower's wait for the leader's result; None if should_stop() turns true first
+        while True:
+            try:
+                return future.result(timeout=POLL_SECONDS)
+            except FutureTimeout:
+                if should_stop is not None and should_stop():
+                    return None
+
+    async def asingle_flight(self, key, fn):
+        # await fn() once for every caller asking for key at the same time, however many threads and event loops ask
+        while True:
+            future, leader = self.join(key)
+            if not leader:
+                try:
+                    # Shielded, so a cancelled follower does not cancel the answer for everyone else
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except FlightCancelled:
+                    continue
+            try:
+                result = await fn()
+            except BaseException as e:
+                self.finish(key, error=e)
+                raise
+            self.finish(key, result)
+            return result
+
+    def pause(self, seconds, should_stop=None):
+        # time.sleep that raises FlightCancelled as soon as should_stop() turns true
+        deadline = time.monotonic() + seconds
+        while True:
+            if should_stop is not None and should_stop():
+                raise FlightCancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, POLL_SECONDS))
+
+    async def apause(self, seconds, should_stop=None):
+        # pause for coroutines
+        deadline = time.monotonic() + seconds
+        while True:
+            if should_stop is not None and should_stop():
+                raise FlightCancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, POLL_SECONDS))
+
+    @contextmanager
+    def slot(self, should_stop=None):
+        self._count('queued')
+        try:
+            self.pause(self.bucket.reserve(), should_stop)
+            while not self._slots.acquire(timeout=POLL_SECONDS):
+                self.pause(0, should_stop)
+        finally:
+            self._count('queued', -1)
+        self._count('in_flight')
+        self._count('requests_total')
+        try:
+            yield
+        finally:
+            self._count('in_flight', -1)
+            self._slots.release()
+
+    @asynccontextmanager
+    async def aslot(self, should_stop=None):
+        # The slots are shared with threads, so an event loop polls for one instead of blocking
+        self._count('queued')
+        try:
+            await self.apause(self.bucket.reserve(), should_stop)
+            while not self._slots.acquire(blocking=False):
+                await self.apause(POLL_SECONDS, should_stop)
+        finally:
+            self._count('queued', -1)
+        self._count('in_flight')
+        self._count('requests_total')
+        try:
+            yield
+        finally:
+            self._count('in_flight', -1)
+            self._slots.release()
+
+    def retry_delay(self, error, attempt):
+        # Seconds to back off before trying again, or None if the error should be raised
+        import openai
+        if attempt >= self.max_retries:
+            return None
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in RETRY_STATUSES:
+                return None
+            retry_after = error.response.headers.get('retry-after')
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+        # Full jitter, so sessions rate limited together do not all come back together
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        try:
+            return max(delay, min(float(retry_after), self.backoff_cap))
+        except (TypeError, ValueError):
+            return delay
+
+    async def asend(self, fn, should_stop=None):
+        # await fn() under the rate limit and the in-flight cap, retried while retry_delay allows;
+        # once should_stop() turns true no further attempt is made
+        attempt = 0
+        while True:
+            async with self.aslot(should_stop):
+                try:
+                    return await fn()
+                except Exception as e:
+                    delay = self.retry_delay(e, attempt)
+                    if delay is None:
+                        self._count('failures_total')
+                        raise
+            self._count('retries_total')
+            await self.apause(delay, should_stop)
+            attempt += 1
+
+    def stream(self, fn, should_stop=None):
+        # fn() under the rate limit and the in-flight cap, for a streamed response read on a thread: the slot
+        # is held until the stream is read to the end, and only opening it is retried, since chunks already
+        # passed on cannot be taken back. Waits for a token, a slot or a retry end early with
+        # FlightCancelled once should_stop() turns true.
+        attempt = 0
+        while True:
+            with self.slot(should_stop):
+                try:
+                    response = fn()
+                except Exception as e:
+                    delay = self.retry_delay(e, attempt)
+                    if delay is None:
+                        self._count('failures_total')
+                        raise
+                else:
+                    try:
+                        yield from response
+                    finally:
+                        response.close()
+                    return
+            self._count('retries_total')
+            self.pause(delay, should_stop)
+            attempt += 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_gateway():
+    config = load_config()
+    return OpenAIGateway(requests_per_minute=config.get('openai_requests_per_minute', REQUESTS_PER_MINUTE),
+                         max_in_flight=config.get('openai_max_in_flight', MAX_IN_FLIGHT))
+
+
+def gateway_metrics():
+    return {f'population_openai_{name}': value for name, value in get_gateway().metrics().items()}
+
+
+register_gauges(gateway_metrics)
+
+
+class ProjectionStreamParser:
+    # Pulls complete {"Year": ..., "Population": ...} objects out of a partial JSON response.
+    # The records are flat objects, so each one can be decoded as soon as its closing brace arrives.
+    def __init__(self):
+        self.text = ''
+        self._position = 0
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, chunk):
+        self.text += chunk
+        records = []
+        while True:
+            start = self.text.find('{', self._position)
+            if start == -1:
+                return records
+            try:
+                item, end = self._decoder.raw_decode(self.text, start)
+            except json.JSONDecodeError:
+                # Either incomplete, or an opening brace we can't use yet; wait for more text
+                if '}' not in self.text[start:]:
+                    return records
+                self._position = start + 1
+                continue
+            self._position = end
+            if isinstance(item, dict) and 'Year' in item and 'Population' in item:
+                records.append(item)
+
+
+def stream_population_projection(prompt, should_stop=None):
+    # Yields each record as soon as the model has finished writing it. A session asking for a prompt
+    # that another is already streaming waits for those records instead of sending its own request.
+    gateway = get_gateway()
+    key = ProjectionCache.key(prompt)
+    while True:
+        cached = get_projection_cache().get(prompt)
+        if cached is not None:
+            yield from cached
+            return
+        future, leader = gateway.join(key)
+        if leader:
+            break
+        try:
+            records = gateway.wait(future, should_stop)
+        except FlightCancelled:
+            continue
+        if records is not None:
+            yield from records
+        return
+
+    try:
+        records = yield from stream_records(prompt, should_stop)
+    except BaseException as e:
+        gateway.finish(key, error=e)
+        raise
+    if records is None:
+        gateway.finish(key, error=FlightCancelled())
+        return
+    get_projection_cache().put(prompt, records)
+    gateway.finish(key, records)
+
+
+def stream_records(prompt, should_stop):
+    # Yields records as they arrive and returns them all, or None if should_stop() turned true
+    stream = get_gateway().stream(lambda: get_client().chat.completions.create(
+        model=MODEL,
+        messages=projection_messages(prompt),
+        stream=True
+    ), should_stop)
+    parser = ProjectionStreamParser()
+    records = []
+    finish_reason = None
+    try:
+        for chunk in stream:
+            if should_stop is not None and should_stop():
+                return None
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            for record in parser.feed(chunk.choices[0].delta.content):
+                records.append(record)
+                yield record
+    except FlightCancelled:
+        # Stopped while queued for the rate limit or backing off, before any response was read
+        return None
+    finally:
+        stream.close()
+
+    if not records:
+        raise ProjectionError(f"Error decoding JSON: no records in response\nRaw response: {parser.text}")
+    # Cut off by the token limit, a dropped connection or an early stop: never cached as a projection
+    check_finished(finish_reason)
+    validate_records(records)
+    return records
+
+
+def check_finished(finish_reason):
+    if finish_reason != "stop":
+        raise ProjectionError(f"Incomplete response: the model stopped with finish_reason={finish_reason!r}")
+
+
+def validate_records(records):
+    # A projection is usable only if it covers every year exactly once with a plausible population
+    try:
+        years = sorted(int(record['Year']) for record in records)
+        populations = np.array([record['Population'] for record in records], dtype=float)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ProjectionError(f"Error in data structure: {str(e)}") from e
+    if years != list(PROJECTION_YEARS):
+        missing = sorted(set(PROJECTION_YEARS) - set(years))
+        raise ProjectionError(f"Error in data structure: expected one record for each year {PROJECTION_YEARS[0]}-"
+                              f"{PROJECTION_YEARS[-1]}, got {len(records)} records"
+                              + (f", {len(missing)} years missing from {missing[0]}" if missing else ""))
+    if not (np.isfinite(populations).all() and (populations >= 0).all()):
+        raise ProjectionError("Error in data structure: populations must be non-negative numbers")
+
+
+def batch_messages(prompt):
+    return [
+        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Scenario: {prompt}"},
+    ]
+
+
+async def request_deltas(client, semaphore, prompt, should_stop=None):
+    # The raw delta list for one scenario; the semaphore bounds how many of this batch's requests are
+    # open, the gateway how many the whole process sends
+    async with semaphore:
+        return await get_gateway().asingle_flight(ProjectionCache.key(prompt, MODEL, BATCH_SYSTEM_PROMPT),
+                                                  lambda: fetch_deltas(client, prompt, should_stop))
+
+
+async def fetch_deltas(client, prompt, should_stop=None):
+    response = await get_gateway().asend(lambda: client.chat.completions.create(
+        model=MODEL,
+        messages=batch_messages(prompt),
+        response_format={"type": "json_object"},
+    ), should_stop)
+    content = response.choices[0].message.content
+    try:
+        return json.loads(content)['delta_percent']
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ProjectionError(f"Error decoding JSON: {str(e)}\nRaw response: {content}") from e
+
+
+def validate_deltas(responses):
+    # Checks every answer at once: a (scenario, year) array of percentages, and a mask of the usable rows
+    deltas = np.full((len(responses), len(PROJECTION_YEARS)), np.nan)
+    for row, response in enumerate(responses):
+        if isinstance(response, list) and len(response) == len(PROJECTION_YEARS):
+            try:
+                deltas[row] = np.asarray(response, dtype=float)
+            except (TypeError, ValueError):
+                pass
+    valid = np.isfinite(deltas).all(axis=1) & (deltas >= DELTA_LIMITS[0]).all(axis=1) & (deltas <= DELTA_LIMITS[1]).all(axis=1)
+    return deltas, valid
+
+
+async def request_projection_batch(prompts, concurrency=BATCH_CONCURRENCY, on_result=None, should_stop=None):
+    # One projection per prompt, in order: {'Year': ..., 'Population': ...} arrays, or a ProjectionError.
+    # Cached prompts are answered without a request; on_result(index) is called as each one settles.
+    # Once should_stop() turns true no further request is sent, and prompts left unanswered come back as None.
+    cache = get_projection_cache()
+    results = [None] * len(prompts)
+    pending = []
+    for index, prompt in enumerate(prompts):
+        cached = cache.get(prompt, system_prompt=BATCH_SYSTEM_PROMPT)
+        if cached is not None:
+            results[index] = projection_arrays(cached)
+            if on_result is not None:
+                on_result(index)
+        else:
+            pending.append(index)
+
+    if pending:
+        client = get_async_client()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def settle(index):
+            try:
+                return await request_deltas(client, semaphore, prompts[index], should_stop)
+            except FlightCancelled:
+                return None
+            except Exception as e:
+                return e if isinstance(e, ProjectionError) else ProjectionError(f"Error in API call: {str(e)}")
+            finally:
+                if on_result is not None:
+                    on_result(index)
+
+        try:
+            responses = await asyncio.gather(*(settle(index) for index in pending))
+        finally:
+            await client.close()
+
+        deltas, valid = validate_deltas(responses)
+        for row, index in enumerate(pending):
+            if responses[row] is None:
+                continue
+            if isinstance(responses[row], ProjectionError):
+                results[index] = responses[row]
+            elif not valid[row]:
+                results[index] = ProjectionError(
+                    f"Error in data structure: expected {len(PROJECTION_YEARS)} deltas within {DELTA_LIMITS}")
+            else:
+                population = BASELINE_POPULATION * (1 + deltas[row] / 100)
+                records = [{'Year': year, 'Population': float(value)} for year, value in zip(PROJECTION_YEARS, population)]
+                cache.put(prompts[index], records, system_prompt=BATCH_SYSTEM_PROMPT)
+                results[index] = projection_arrays(records)
+    return results
+
+
+def generate_projection_batch(prompts, concurrency=BATCH_CONCURRENCY, on_result=None, should_stop=None):
+    # Blocking entry point for worker threads, which have no event loop of their own
+    return asyncio.run(request_projection_batch(prompts, concurrency, on_result, should_stop))
+
+
+def projection_arrays(records):
+    # The compact form a session keeps: two small arrays instead of a list of rows
+    return {
+        'Year': np.array([record['Year'] for record in records], dtype=np.uint16),
+        'Population': np.array([record['Population'] for record in records], dtype=float),
+    }
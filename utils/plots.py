@@ -1,30 +1,53 @@
+import copy
+import functools
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from utils.data_processing import load_data, filter_data, format_number
+from utils.instrumentation import instrumented
+from utils.data_processing import load_cube, filter_data, format_number
 
 
-def plot_population_projection(df, show_base_projection, is_generated=False):
+@instrumented('plot_population_projection')
+def plot_population_projection(data, show_base_projection, is_generated=False, uncertainty=None):
 
     if is_generated:
-        fig = px.line(df, x='Year', y='Population', title='Population Projection (AI Generated)')
+        # One 'Population' series, or one column per scenario from a batch
+        series = [column for column in data if column != 'Year']
+        fig = px.line(data, x='Year', y='Population' if series == ['Population'] else series,
+                      title='Population Projection (AI Generated)')
     else:
-        yearly_data = df.groupby('Year')['Count'].sum().reset_index()
-        yearly_data['Count'] = yearly_data['Count'] * 19 * 10  # Adjust as needed
-        fig = px.line(yearly_data, x='Year', y='Count', title='Population Projection')
+        yearly_counts = data.yearly_totals() * 19 * 10  # Adjust as needed
+        fig = px.line(x=data.years, y=yearly_counts, labels={'x': 'Year', 'y': 'Count'}, title='Population Projection')
     
+    if uncertainty is not None:
+        # Monte Carlo interval around the projection: upper bound first, lower bound filled up to it
+        fig.add_trace(go.Scatter(
+            x=uncertainty.years, y=uncertainty.upper * 19 * 10,
+            mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'
+        ))
+        fig.add_trace(go.Scatter(
+            x=uncertainty.years, y=uncertainty.lower * 19 * 10,
+            mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(99, 110, 250, 0.2)',
+            name='95% Interval'
+        ))
+
     if show_base_projection:
         # Add reference line for asmr_0_asfr_0
-        reference_df = filter_data(load_data(), 'asmr_0_asfr_0')
-        reference_data = reference_df.groupby('Year')['Count'].sum().reset_index()
-        reference_data['Count'] = reference_data['Count'] * 19 * 10
+        cube = load_cube() if is_generated else data.cube
+        reference = filter_data(cube, 'asmr_0_asfr_0')
         fig.add_trace(go.Scatter(
-            x=reference_data['Year'],
-            y=reference_data['Count'],
+            x=reference.years,
+            y=reference.yearly_totals() * 19 * 10,
             mode='lines',
             name='Base Projection',
             line=dict(color='rgb(0, 255, 127)')
         ))
 
+    style_projection(fig)
+    return fig
+
+
+def style_projection(fig):
     fig.update_layout(
         showlegend=True,
         legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
@@ -44,31 +67,49 @@ def plot_population_projection(df, show_base_projection, is_generated=False):
         ),
         yaxis=dict(title='Population', showgrid=False, tickfont=dict(size=14))
     )
+
+
+@instrumented('plot_comparison_projection')
+def plot_comparison_projection(comparison, names, colors):
+    # Every scenario's line from the comparison's stacked totals
+    fig = go.Figure([
+        go.Scatter(x=comparison.years, y=totals * 19 * 10, mode='lines', name=name, line=dict(color=color, width=2))
+        for totals, name, color in zip(comparison.totals, names, colors)
+    ])
+    fig.update_layout(title='Population Projection')
+    style_projection(fig)
+    return fig
+
+
+@instrumented('plot_yearly_difference')
+def plot_yearly_difference(comparison, names, colors, relative=False):
+    # Each scenario's total against the reference scenario's, year by year
+    difference = comparison.yearly_difference(relative) * (100 if relative else 19 * 10)
+    fig = go.Figure([
+        go.Scatter(x=comparison.years, y=difference[i], mode='lines', name=names[i], line=dict(color=colors[i], width=2),
+                   hovertemplate='%{y:,.2f}%' if relative else '%{y:,.0f}')
+        for i in range(len(names)) if i != comparison.reference
+    ])
+    fig.update_layout(title=f"Difference from {names[comparison.reference]}")
+    style_projection(fig)
+    fig.update_yaxes(title='Difference (%)' if relative else 'Difference', zeroline=True, zerolinecolor='gray')
     return fig
 
 
-def plot_population_composition(all_df, year, title):
-    df = all_df[all_df['Year'] == year]
-    male_data = df[df['Gender'] == 'M'].sort_values('AgeGroup')
-    female_data = df[df['Gender'] == 'F'].sort_values('AgeGroup')
+# Bars whose label would not fit inside (under this share of the longest bar) are labelled at their end
+INSIDE_LABEL_SHARE = 0.15
 
+
+@functools.lru_cache(maxsize=None)
+def composition_template():
+    # The pyramid's traces and layout, validated once; each figure only swaps its numbers and title in
     fig = go.Figure()
-    fig.add_trace(go.Bar(
-        y=male_data['AgeGroup'],
-        x=male_data['Count'] * 19,
-        name='Male',
-        orientation='h',
-        marker_color='#1e3799'
-    ))
-    fig.add_trace(go.Bar(
-        y=female_data['AgeGroup'],
-        x=-female_data['Count'] * 19,
-        name='Female',
-        orientation='h',
-        marker_color='#b71540'
-    ))
+    fig.add_trace(go.Bar(name='Male', orientation='h', marker_color='#1e3799'))
+    fig.add_trace(go.Bar(name='Female', orientation='h', marker_color='#b71540'))
+    # Every bar's count as one text trace, rather than an annotation per bar
+    fig.add_trace(go.Scatter(mode='text', textfont=dict(color='white', size=12), hoverinfo='skip'))
     fig.update_layout(
-        title=title,
+        title='',
         barmode='relative',
         yaxis=dict(title=None, showgrid=False, tickfont=dict(size=14)),
         xaxis=dict(title=None, showgrid=False, showticklabels=False, zeroline=False),
@@ -80,29 +121,59 @@ def plot_population_composition(all_df, year, title):
         showlegend=False,
         height=500,
     )
+    return fig.to_dict()
+
+
+@instrumented('plot_population_composition')
+def plot_population_composition(data, year, title):
+    counts = data.year(year) * 19
+    male_counts = counts[data.cube.gender_index['M']]
+    female_counts = counts[data.cube.gender_index['F']]
 
-    max_count = max(male_data['Count'].max() * 19, female_data['Count'].max() * 19)
-
-    for i, m in enumerate(male_data['Count'] * 19):
-        x_pos = m if m / max_count < 0.15 else m / 2
-        align = 'left' if m / max_count < 0.15 else 'center'
-        fig.add_annotation(
-            x=x_pos, y=i,
-            text=format_number(m),
-            showarrow=False,
-            font=dict(color='white', size=12),
-            xanchor=align
-        )
-
-    for i, f in enumerate(female_data['Count'] * 19):
-        x_pos = -f if f / max_count < 0.15 else -f / 2
-        align = 'right' if f / max_count < 0.15 else 'center'
-        fig.add_annotation(
-            x=x_pos, y=i,
-            text=format_number(f),
-            showarrow=False,
-            font=dict(color='white', size=12),
-            xanchor=align
-        )
-
-    return fig
\ No newline at end of file
+    # Labels sit in the middle of long bars and just past the end of short ones; female bars point left
+    max_count = max(male_counts.max(), female_counts.max())
+    inside = np.concatenate([male_counts, female_counts]) / max_count >= INSIDE_LABEL_SHARE
+    sign = np.repeat([1, -1], len(male_counts))
+    ends = np.concatenate([male_counts, -female_counts])
+    label_x = np.where(inside, ends / 2, ends)
+    positions = np.where(inside, 'middle center', np.where(sign > 0, 'middle right', 'middle left'))
+
+    template = copy.deepcopy(composition_template())
+    male, female, labels = template['data']
+    male.update(y=data.age_groups, x=male_counts)
+    female.update(y=data.age_groups, x=-female_counts)
+    labels.update(y=list(data.age_groups) * 2, x=label_x, textposition=positions,
+                  text=[format_number(count) for count in np.abs(ends)])
+    template['layout']['title']['text'] = title
+    # Already validated: only arrays of the template's own types were swapped in
+    return go.Figure(template, _validate=False)
+
+
+@instrumented('plot_difference_pyramid')
+def plot_difference_pyramid(comparison, index, year, title, relative=False):
+    # Male and female differences from the reference scenario side by side in each age group
+    scale = 100 if relative else 19
+    fig = go.Figure()
+    for gender, name, color in (('M', 'Male', '#1e3799'), ('F', 'Female', '#b71540')):
+        fig.add_trace(go.Bar(
+            y=comparison.age_groups,
+            x=comparison.pyramid_difference(year, gender, relative)[index] * scale,
+            name=name,
+            orientation='h',
+            marker_color=color,
+            hovertemplate='%{y}: %{x:,.2f}%' if relative else '%{y}: %{x:,.0f}'
+        ))
+    fig.update_layout(
+        title=title,
+        barmode='group',
+        yaxis=dict(title=None, showgrid=False, tickfont=dict(size=14)),
+        xaxis=dict(title='Difference (%)' if relative else 'Difference', showgrid=False, zeroline=True,
+                   zerolinecolor='gray'),
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        font_color='#444',
+        title_font_size=20,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        height=500,
+    )
+    return fig
@@ -0,0 +1,54 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+
+# CPU budget for background work: a quarter of the cores, and a cap on queued figures
+PREWARM_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+PREWARM_MAX_PENDING = 32
+
+
+class Prewarmer:
+    # Builds figures on a small thread pool and stores them in a FigureCache ahead of use
+    def __init__(self, max_workers=PREWARM_WORKERS, max_pending=PREWARM_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prewarm')
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def submit(self, owner, cache, jobs):
+        # A newer request from the same owner supersedes whatever it still has queued
+        self.cancel(owner)
+        with self._lock:
+            for key, build in jobs:
+                if key in self._pending or key in cache:
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    break
+                future = self._executor.submit(self._build, cache, key, build)
+                self._pending[key] = (owner, future)
+                future.add_done_callback(lambda _, key=key: self._forget(key))
+
+    def cancel(self, owner=None):
+        # Only queued work can be cancelled; a figure already being built is left to finish
+        with self._lock:
+            for key, (pending_owner, future) in list(self._pending.items()):
+                if owner is None or pending_owner == owner:
+                    future.cancel()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _build(self, cache, key, build):
+        if key not in cache:
+            cache.put(key, build())
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+
+@st.cache_resource
+def get_prewarmer():
+    return Prewarmer()
@@ -0,0 +1,204 @@
+import numpy as np
+from utils.data_processing import get_combination, parse_combination
+from utils.schema import age_group_bounds, natural_age_order
+
+BASELINE_COMBINATION = 'asmr_0_asfr_0'
+REPRODUCTIVE_AGES = (15, 50)
+DEFAULT_AGE_GROUP_WIDTH = 5
+# Used when the data has no one-step neighbours of the baseline to calibrate against
+DEFAULT_MORTALITY_STEP = 0.1
+DEFAULT_FERTILITY_STEP = 0.1
+STEP_CANDIDATES = np.linspace(-1.0, 1.0, 401)
+# One unit of migration is a net inflow of one per thousand residents a year
+MIGRATION_UNIT = 1e-3
+
+class CohortComponentModel:
+    # Annual cohort-component projection by gender and age group.
+    # Each year a 1/width share of every closed age group moves up a group, births enter the
+    # first group, and everyone is then multiplied by their group's survival rate.
+    # Age arrays are held in natural age order; results come back in the cube's age order.
+    def __init__(self, years, base_population, survival, fertility, birth_shares, widths, female,
+                 output_order, mortality_step=DEFAULT_MORTALITY_STEP, fertility_step=DEFAULT_FERTILITY_STEP,
+                 correction=None):
+        self.years = np.asarray(years)
+        self.base_population = base_population
+        self.survival = survival
+        self.fertility = fertility
+        self.birth_shares = birth_shares
+        self.female = female
+        self.output_order = output_order
+        self.mortality_step = mortality_step
+        self.fertility_step = fertility_step
+        self.correction = correction
+        self.widths = widths
+        # Set by anchor(); None leaves the engine as it is
+        self.anchor_ratio = None
+
+        # The oldest group is open-ended, so nobody ages out of it
+        self.move = 1.0 / widths
+        self.move[-1] = 0.0
+        self.stay = 1.0 - self.move
+
+    @classmethod
+    def from_cube(cls, cube, baseline=BASELINE_COMBINATION):
+        order = natural_age_order(cube.age_groups)
+        bounds = [age_group_bounds(cube.age_groups[i]) for i in order]
+        widths = np.array([b[1] - b[0] if b and b[1] else DEFAULT_AGE_GROUP_WIDTH for b in bounds], dtype=float)
+        female = cube.gender_index.get('F', 0)
+
+        # Baseline history in natural age order: (year, gender, age)
+        history = np.asarray(cube.counts[cube.combination_index[baseline]])[:, :, order]
+        model = cls(cube.years, history[0].copy(), np.ones(history.shape[1:]), np.zeros(len(order)),
+                    np.full(history.shape[1], 1.0 / history.shape[1]), widths, female, np.argsort(order))
+
+        # Survival for each closed cell: least-squares ratio of next year's count to this year's aged count
+        current, following = history[:-1], history[1:]
+        aged = current * model.stay
+        aged[..., 1:] += current[..., :-1] * model.move[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            survival = (following * aged).sum(axis=0) / (aged * aged).sum(axis=0)
+
+        # The first group also receives births. Its survival is taken from the next group (the two
+        # are too collinear with births to fit jointly), which leaves one flat fertility rate over
+        # the reproductive ages to fit from the newborns that are left unexplained
+        reproductive = np.array([bool(b) and REPRODUCTIVE_AGES[0] <= b[0] < REPRODUCTIVE_AGES[1] for b in bounds])
+        if not reproductive.any():
+            reproductive[:] = True
+        survival = np.clip(np.nan_to_num(survival, nan=1.0), 0.0, 1.0)
+        survival[:, 0] = survival[:, 1] if survival.shape[1] > 1 else 1.0
+        newborns = history[:, :, 0].sum(axis=0)
+        if newborns.sum() > 0:
+            model.birth_shares = newborns / newborns.sum()
+
+        mothers = current[:, female][:, reproductive].sum(axis=1)
+        unexplained = following[..., 0].sum(axis=1) - (survival[:, 0] * current[..., 0] * model.stay[0]).sum(axis=1)
+        newborn_survival = (survival[:, 0] * model.birth_shares).sum()
+        births_per_mother = (unexplained * mothers).sum() / max(newborn_survival * (mothers * mothers).sum(), 1e-12)
+
+        model.survival = survival
+        model.fertility = np.where(reproductive, max(births_per_mother, 0.0), 0.0)
+
+        # Scale away what the fitted rates miss (migration, rounding), so the baseline is reproduced exactly
+        fitted = model.run(np.ones(1), np.ones(1))[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            model.correction = np.where(fitted > 0, history / fitted, 1.0)
+
+        model.mortality_step = model.calibrate_step(cube, 'mortality', DEFAULT_MORTALITY_STEP)
+        model.fertility_step = model.calibrate_step(cube, 'fertility', DEFAULT_FERTILITY_STEP)
+        model.anchor(cube)
+        return model
+
+    def run(self, mortality_multiplier, fertility_multiplier, migration_rate=None):
+        # Vectorized over a batch of scenarios: multipliers are (batch,), the result is
+        # (batch, year, gender, age) in natural age order, without the output reordering.
+        # Net migration is a yearly rate on top of the baseline's, spread like the population.
+        mortality_multiplier = np.asarray(mortality_multiplier, dtype=float)
+        fertility_multiplier = np.asarray(fertility_multiplier, dtype=float)
+        growth = None if migration_rate is None else 1.0 + np.asarray(migration_rate, dtype=float)[:, None, None]
+        survival = np.clip(1.0 - (1.0 - self.survival) * mortality_multiplier[:, None, None], 0.0, 1.0)
+        fertility = self.fertility * fertility_multiplier[:, None]
+
+        population = np.broadcast_to(self.base_population, survival.shape).copy()
+        result = np.empty((len(survival), len(self.years)) + self.base_population.shape)
+        result[:, 0] = population
+        for t in range(1, len(self.years)):
+            births = (population[:, self.female] * fertility).sum(axis=-1)
+            aged = population * self.stay
+            aged[..., 1:] += population[..., :-1] * self.move[:-1]
+            aged[..., 0] += births[:, None] * self.birth_shares
+            population = aged * survival
+            if growth is not None:
+                population *= growth
+            result[:, t] = population
+
+        if self.correction is not None:
+            result *= self.correction
+        return result
+
+    def multipliers(self, asmr, asfr):
+        # Slider units act exponentially on the rates, so fractional and out-of-grid values are fine
+        asmr, asfr = np.broadcast_arrays(np.atleast_1d(np.asarray(asmr, dtype=float)),
+                                         np.atleast_1d(np.asarray(asfr, dtype=float)))
+        return np.exp(self.mortality_step * asmr), np.exp(self.fertility_step * asfr)
+
+    def project(self, asmr=0.0, asfr=0.0, migration=0.0):
+        # (batch, year, gender, age) in the cube's age order for arrays of adjustments,
+        # (year, gender, age) for scalars
+        scalar = np.ndim(asmr) == 0 and np.ndim(asfr) == 0 and np.ndim(migration) == 0
+        asmr, asfr, migration = np.broadcast_arrays(*(np.atleast_1d(np.asarray(value, dtype=float))
+                                                      for value in (asmr, asfr, migration)))
+        mortality_multiplier, fertility_multiplier = self.multipliers(asmr, asfr)
+        migration_rate = migration * MIGRATION_UNIT if migration.any() else None
+        result = self.run(mortality_multiplier, fertility_multiplier, migration_rate)[..., self.output_order]
+        return result[0] if scalar else result
+
+    def anchor(self, cube):
+        # Data over engine for every whole-step scenario in the data, on the (asmr, asfr) lattice.
+        # Lattice points missing from the data keep the engine as it is.
+        points = [(index, parse_combination(combination)) for combination, index in cube.combination_index.items()]
+        points = [(index, adjustment) for index, adjustment in points
+                  if adjustment is not None and all(float(value).is_integer() for value in adjustment)]
+        if not points:
+            return
+        indices, adjustments = zip(*points)
+        asmr, asfr = np.array(adjustments).T
+        self.anchor_asmr = np.arange(asmr.min(), asmr.max() + 1)
+        self.anchor_asfr = np.arange(asfr.min(), asfr.max() + 1)
+        engine = self.project(asmr, asfr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(engine > 0, np.asarray(cube.counts[list(indices)]) / engine, 1.0)
+        self.anchor_ratio = np.ones((len(self.anchor_asmr), len(self.anchor_asfr)) + engine.shape[1:])
+        self.anchor_ratio[(asmr - asmr.min()).astype(int), (asfr - asfr.min()).astype(int)] = ratio
+
+    def project_anchored(self, asmr=0.0, asfr=0.0, migration=0.0):
+        # The engine scaled by anchor_factor: the data itself on the grid, and between its neighbours off it
+        result = self.project(asmr, asfr, migration)
+        ratio = self.anchor_factor(asmr, asfr)
+        if ratio is None:
+            return result
+        return result * (ratio[0] if result.ndim == 3 else ratio)
+
+    def anchor_factor(self, asmr=0.0, asfr=0.0):
+        # (batch, year, gender, age) in the cube's age order: the data/engine ratio interpolated between
+        # the four surrounding whole-step scenarios, or None without anchors. Beyond the grid the ratio
+        # of its nearest edge is kept.
+        if self.anchor_ratio is None:
+            return None
+        asmr, asfr = np.broadcast_arrays(np.atleast_1d(np.asarray(asmr, dtype=float)),
+                                         np.atleast_1d(np.asarray(asfr, dtype=float)))
+        weights = []
+        for values, axis in ((asmr, self.anchor_asmr), (asfr, self.anchor_asfr)):
+            position = np.clip(values, axis[0], axis[-1]) - axis[0]
+            lower = np.minimum(np.floor(position).astype(int), len(axis) - 2) if len(axis) > 1 else np.zeros(len(values), int)
+            weights.append((lower, np.clip(position - lower, 0.0, 1.0)))
+        (i, s), (j, t) = weights
+        i1, j1 = np.minimum(i + 1, len(self.anchor_asmr) - 1), np.minimum(j + 1, len(self.anchor_asfr) - 1)
+        s, t = s[:, None, None, None], t[:, None, None, None]
+        return ((1 - s) * (1 - t) * self.anchor_ratio[i, j] + (1 - s) * t * self.anchor_ratio[i, j1]
+                + s * (1 - t) * self.anchor_ratio[i1, j] + s * t * self.anchor_ratio[i1, j1])
+
+    def calibrate_step(self, cube, parameter, default):
+        # Choose the per-unit effect that best reproduces the data's one-step neighbours of the baseline
+        offsets = [offset for offset in (-1, 1)
+                   if self._combination(parameter, offset) in cube.combination_index]
+        if not offsets:
+            return default
+
+        steps = np.repeat(STEP_CANDIDATES, len(offsets))
+        units = np.tile(offsets, len(STEP_CANDIDATES))
+        ones = np.ones_like(steps)
+        multiplier = np.exp(steps * units)
+        if parameter == 'mortality':
+            totals = self.run(multiplier, ones).sum(axis=(2, 3))
+        else:
+            totals = self.run(ones, multiplier).sum(axis=(2, 3))
+
+        targets = np.array([cube.totals[cube.combination_index[self._combination(parameter, offset)]]
+                            for offset in offsets])
+        targets = np.tile(targets, (len(STEP_CANDIDATES), 1))
+        errors = (((totals - targets) / targets) ** 2).sum(axis=1).reshape(len(STEP_CANDIDATES), len(offsets))
+        return float(STEP_CANDIDATES[errors.sum(axis=1).argmin()])
+
+    @staticmethod
+    def _combination(parameter, offset):
+        return get_combination(offset, 0) if parameter == 'mortality' else get_combination(0, offset)
@@ -0,0 +1,82 @@
+import math
+import numpy as np
+import plotly.graph_objects as go
+
+# A wide chart is under 2,000 pixels across: line traces longer than this are decimated to it
+MAX_LINE_POINTS = 2000
+# Traces with more values than this have them rounded to what the chart can resolve
+COMPACT_POINTS = 1000
+# Figures with more scatter points than this are drawn with WebGL
+WEBGL_POINTS = 10_000
+# Values are kept to this fraction of a trace's range: far finer than a pixel, far shorter than full precision
+VALUE_RESOLUTION = 1e-4
+# Numeric trace properties that grow with the data
+COMPACT_PROPERTIES = ('x', 'y', 'z', 'customdata', 'marker.color')
+
+
+def decimate(y, max_points=MAX_LINE_POINTS):
+    # Indices of the lowest and highest point in each of max_points / 2 buckets, plus both ends:
+    # the drawn line keeps every peak and trough the full series would show
+    n = len(y)
+    size = math.ceil(n / (max_points // 2))
+    buckets = math.ceil(n / size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(buckets, size)
+    starts = np.arange(buckets) * size
+    keep = np.concatenate([starts + np.nanargmin(padded, axis=1), starts + np.nanargmax(padded, axis=1), [0, n - 1]])
+    return np.unique(keep)
+
+
+def compact(values):
+    # Rounded to VALUE_RESOLUTION of the range; whole numbers are sent without a fractional part
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    if finite.size == 0 or finite.max() == finite.min():
+        return values
+    decimals = -math.floor(math.log10((finite.max() - finite.min()) * VALUE_RESOLUTION))
+    values = np.round(values, decimals)
+    if decimals <= 0 and finite.size == values.size and np.abs(values).max() < 2 ** 53:
+        return values.astype(np.int64)
+    return values
+
+
+def is_numeric(values):
+    return values is not None and np.asarray(values).dtype.kind in 'iuf'
+
+
+def prepare_line(trace):
+    # Decimate lines drawn over a sorted numeric x; markers are each meaningful and are left alone
+    x, y = trace.x, trace.y
+    if not (is_numeric(x) and is_numeric(y)) or 'markers' in (trace.mode or 'lines'):
+        return
+    x, y = np.asarray(x), np.asarray(y, dtype=float)
+    if len(y) <= MAX_LINE_POINTS or len(x) != len(y) or not np.isfinite(y).all() or (np.diff(x) < 0).any():
+        return
+    keep = decimate(y)
+    trace.update(x=x[keep], y=y[keep])
+
+
+def prepare_figure(fig):
+    # What the browser gets: decimated lines, rounded long arrays and WebGL for many points.
+    # Small figures, which is most of them, pass through untouched.
+    for trace in fig.data:
+        if trace.type in ('scatter', 'scattergl'):
+            prepare_line(trace)
+        for name in COMPACT_PROPERTIES:
+            if name.split('.')[0] not in trace:
+                continue
+            values = trace[name]
+            if is_numeric(values) and np.size(values) > COMPACT_POINTS:
+                trace[name] = compact(values)
+
+    scatter_points = sum(len(trace.x) for trace in fig.data if trace.type == 'scatter' and trace.x is not None)
+    if scatter_points > WEBGL_POINTS:
+        # Properties WebGL traces lack are dropped rather than failing the chart. Swapping the traces
+        # in place keeps their order and avoids validating the whole figure again.
+        traces = [go.Scattergl({key: value for key, value in trace.to_plotly_json().items() if key != 'type'},
+                               skip_invalid=True) if trace.type == 'scatter' else trace
+                  for trace in fig.data]
+        fig.data = []
+        fig.add_traces(traces)
+    return fig
@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import numpy as np
+import streamlit as st
+from utils.data_processing import load_cube, parse_combination
+from utils.microsim import AgentSimulator, MicrosimResult, UNCERTAINTY_AGENTS, UNCERTAINTY_REPLICATIONS
+
+# Replications are CPU-bound and independent; half the cores, so reruns of other sessions keep the rest
+REPLICATION_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+UNCERTAINTY_CACHE_SIZE = 64
+
+
+class ReplicationRunner:
+    # Runs Monte Carlo replications of many scenarios on a process pool.
+    # Every replication gets its own child of one SeedSequence, so results depend on the seed
+    # only, never on how replications were spread over workers. Workers write their counts
+    # straight into a shared-memory block; only indices travel back through the pool. The model
+    # goes to each worker once, when the pool starts, and tasks carry just their settings.
+    def __init__(self, max_workers=REPLICATION_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def run(self, model, scenarios, replications, n_agents, seed=0, progress=None, should_stop=None):
+        # scenarios is a list of (asmr, asfr); the result is (scenario, replication, year, gender, age)
+        # in the cube's age order. progress(done, total) is called as replications finish, and
+        # should_stop() is checked between them; None comes back when it asks to stop.
+        shape = (len(scenarios), replications, len(model.years)) + model.base_population.shape
+        seeds = np.random.SeedSequence(seed).spawn(len(scenarios) * replications)
+        tasks = [(index, *scenarios[index // replications], seeds[index]) for index in range(len(seeds))]
+
+        if self.max_workers <= 1:
+            return self._run_inline(model, tasks, shape, n_agents, progress, should_stop)
+
+        block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+        try:
+            pool = self._pool(model)
+            futures = [pool.submit(_run_replication, block.name, shape, n_agents, *task) for task in tasks]
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    if progress is not None:
+                        progress(len(tasks) - len(pending), len(tasks))
+                    if should_stop is not None and should_stop():
+                        return None
+            finally:
+                # Nothing may still be writing to the block once it is released
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+            # One copy out of the block, which is released right after
+            return np.ndarray(shape, dtype=float, buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+                self._model = None
+
+    def _pool(self, model):
+        # Started on first use; spawned rather than forked, since the server process runs threads.
+        # A new model (new data on disk) gets a new pool; runs still on the old one are left to finish
+        with self._lock:
+            if self._executor is not None and self._model is not model:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_set_worker_model, initargs=(model,))
+                self._model = model
+            return self._executor
+
+    @staticmethod
+    def _run_inline(model, tasks, shape, n_agents, progress, should_stop):
+        result = np.empty(shape)
+        simulator = AgentSimulator(model)
+        flat = result.reshape((-1,) + shape[2:])
+        for done, (index, asmr, asfr, seed) in enumerate(tasks, 1):
+            flat[index] = simulator.run_replication(asmr, asfr, n_agents, seed)
+            if progress is not None:
+                progress(done, len(tasks))
+            if should_stop is not None and should_stop():
+                return None
+        return result
+
+
+_worker_simulator = None
+
+
+def _set_worker_model(model):
+    # Pool initializer: the one copy of the model a worker process holds
+    global _worker_simulator
+    _worker_simulator = AgentSimulator(model)
+
+
+def _run_replication(block_name, shape, n_agents, index, asmr, asfr, seed):
+    # Workers share the parent's resource tracker, so attaching here does not take ownership
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        flat = np.ndarray(shape, dtype=float, buffer=block.buf).reshape((-1,) + shape[2:])
+        flat[index] = _worker_simulator.run_replication(asmr, asfr, n_agents, seed)
+    finally:
+        block.close()
+    return index
+
+
+@st.cache_resource
+def get_replication_runner():
+    return ReplicationRunner()
+
+
+@st.cache_resource
+def get_uncertainty_cache():
+    # Results shared by every session, most recently used last. Not st.cache_data: a miss reports
+    # progress into the page, and a cached function may not write to elements made outside it
+    return OrderedDict(), threading.Lock()
+
+
+def simulate_uncertainty(data_key, combination, n_agents=UNCERTAINTY_AGENTS,
+                         replications=UNCERTAINTY_REPLICATIONS, seed=0, progress=None):
+    # data_key changes whenever the file on disk does; None for named scenarios, which have no
+    # slider values. progress(done, total) is only called on a miss.
+    adjustments = parse_combination(combination)
+    if adjustments is None:
+        return None
+    key = (data_key, combination, n_agents, replications, seed)
+    entries, lock = get_uncertainty_cache()
+    with lock:
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+
+    model = load_cube().projection_model()
+    counts = get_replication_runner().run(model, [adjustments], replications, n_agents, seed, progress=progress)
+    result = MicrosimResult(model.years, counts[0])
+    # Shared between sessions, so read-only
+    for values in (result.counts, result.totals, result.mean, result.lower, result.upper):
+        values.flags.writeable = False
+    with lock:
+        entries[key] = result
+        entries.move_to_end(key)
+        while len(entries) > UNCERTAINTY_CACHE_SIZE:
+            entries.popitem(last=False)
+    return result
@@ -0,0 +1,47 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Column types of the population frame. Labels repeat across millions of rows, so they are
+# stored once as categories; years fit in 16 bits and counts keep float32 precision.
+POPULATION_SCHEMA = {
+    'Combination': 'category',
+    'Year': np.uint16,
+    'Gender': 'category',
+    'AgeGroup': 'category',
+    'Count': np.float32,
+}
+
+AGE_GROUP_LABEL = re.compile(r'\s*(\d+)(?:\s*[-–]\s*(\d+))?')
+
+
+def age_group_bounds(label):
+    # '0-4' -> (0, 5), '85+' -> (85, None), '7' -> (7, 8); None when the label has no age in it
+    match = AGE_GROUP_LABEL.match(str(label))
+    if match is None:
+        return None
+    lower = int(match.group(1))
+    if match.group(2) is not None:
+        return lower, int(match.group(2)) + 1
+    return lower, None if '+' in str(label) else lower + 1
+
+
+def natural_age_order(age_groups):
+    # Positions that sort age groups by their lower bound; unparseable labels keep their place at the end
+    keys = [age_group_bounds(label) for label in age_groups]
+    return np.array(sorted(range(len(age_groups)),
+                           key=lambda i: (keys[i] is None, keys[i][0] if keys[i] else i)))
+
+
+def sorted_age_groups(age_groups):
+    age_groups = list(age_groups)
+    return [age_groups[i] for i in natural_age_order(age_groups)]
+
+
+def apply_schema(df):
+    # Cheap when the frame already conforms, as frames read back from parquet do
+    df = df.astype(POPULATION_SCHEMA, copy=False)
+    age_groups = pd.CategoricalDtype(sorted_age_groups(df['AgeGroup'].cat.categories), ordered=True)
+    if df['AgeGroup'].dtype != age_groups:
+        df['AgeGroup'] = df['AgeGroup'].cat.set_categories(age_groups.categories, ordered=True)
+    return df
@@ -0,0 +1,118 @@
+import argparse
+import sys
+import numpy as np
+import streamlit as st
+from utils.data_processing import ScenarioCube, load_cube, get_combination
+from utils.instrumentation import instrumented
+from utils.schema import age_group_bounds
+from utils.storage import ensure_store, open_store
+
+# Scenarios projected together; bounds the (batch, year, gender, age) block held at once
+SWEEP_BATCH_SIZE = 1024
+# Children are below the first age, the elderly at or above the second
+DEPENDENCY_AGES = (15, 65)
+SWEEP_METRICS = ('population', 'final_population', 'impact', 'volatility', 'dependency_ratio')
+# Metrics that only ever move one way along each axis. Early years of 'population' carry the data's
+# own scenario-to-scenario noise, so it is not one of them
+MONOTONE_METRICS = ('final_population', 'impact')
+
+
+def sweep_values(start, stop, resolution):
+    # Evenly spaced axis values with a fixed step, e.g. sweep_values(-5, 5, 0.1); rounded so
+    # whole values still match the scenarios in the data
+    count = int(round((stop - start) / resolution)) + 1
+    return tuple(float(value) for value in np.round(np.linspace(start, stop, count), 10))
+
+
+@instrumented('run_sweep')
+@st.cache_data(max_entries=16)
+def run_sweep(data_key, asmr_values, asfr_values, migration_values=(0.0,), metrics=SWEEP_METRICS,
+              start_year=2024, end_year=2100):
+    # data_key is only used by st.cache_data: a new file on disk means new results
+    return sweep(load_cube(), asmr_values, asfr_values, migration_values, metrics, start_year, end_year)
+
+
+def sweep(cube, asmr_values, asfr_values, migration_values=(0.0,), metrics=SWEEP_METRICS,
+          start_year=2024, end_year=2100):
+    # Every metric comes out of the same pass over the grid, shaped (asmr, asfr, migration),
+    # with a trailing year axis for 'population'
+    grid_shape = (len(asmr_values), len(asfr_values), len(migration_values))
+    asmr, asfr, migration = (axis.ravel() for axis in np.meshgrid(asmr_values, asfr_values, migration_values,
+                                                                 indexing='ij'))
+    years = np.array([cube.year_index[year] for year in range(start_year, end_year + 1)])
+
+    bounds = [age_group_bounds(label) for label in cube.age_groups]
+    young = np.array([bool(b) and b[0] < DEPENDENCY_AGES[0] for b in bounds])
+    old = np.array([bool(b) and b[0] >= DEPENDENCY_AGES[1] for b in bounds])
+
+    totals = np.empty((len(asmr), len(years)))
+    dependency_ratio = np.empty(len(asmr))
+    # Every cell comes from the same anchored projection, which is the data itself on the data's grid:
+    # mixing stored cells with raw engine output would step between the two
+    model = cube.projection_model()
+    for start in range(0, len(asmr), SWEEP_BATCH_SIZE):
+        batch = slice(start, start + SWEEP_BATCH_SIZE)
+        # The projection always starts at the first year, so the window is cut afterwards
+        counts = model.project_anchored(asmr[batch], asfr[batch], migration[batch])[:, years]
+        totals[batch] = counts.sum(axis=(2, 3))
+        # Only the final year's age structure is kept for the ratio
+        final_ages = counts[:, -1].sum(axis=1)
+        working = final_ages[:, ~(young | old)].sum(axis=1)
+        dependency_ratio[batch] = final_ages[:, young | old].sum(axis=1) / working
+
+    population = totals * 190
+    baseline = cube.totals[cube.combination_index[get_combination(0, 0)], years[-1]] * 190
+    yoy_changes = np.diff(population, axis=-1) / population[:, :-1]
+    results = {
+        'population': population,
+        'final_population': population[:, -1],
+        'impact': (population[:, -1] - baseline) / baseline,
+        'volatility': yoy_changes.std(axis=-1),
+        'dependency_ratio': dependency_ratio,
+    }
+    sweep = {name: results[name].reshape(grid_shape + results[name].shape[1:]) for name in metrics}
+    sweep['axes'] = {'asmr': np.array(asmr_values), 'asfr': np.array(asfr_values),
+                     'migration': np.array(migration_values)}
+    return sweep
+
+
+def non_monotone(sweep, metrics=MONOTONE_METRICS, tolerance=1e-9):
+    # (metric, axis) pairs where some line of the grid along that axis changes direction.
+    # Ties within a relative tolerance are allowed either way.
+    failures = []
+    for name in metrics:
+        if name not in sweep:
+            continue
+        values = sweep[name]
+        scale = np.nanmax(np.abs(values)) * tolerance
+        for axis, axis_name in enumerate(('asmr', 'asfr', 'migration')):
+            if values.shape[axis] < 3:
+                continue
+            steps = np.diff(values, axis=axis)
+            rising, falling = (steps > scale).any(axis=axis), (steps < -scale).any(axis=axis)
+            if (rising & falling).any():
+                failures.append((name, axis_name))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the sweep's metrics move one way along each axis.")
+    parser.add_argument('path', nargs='?', default='data/population_composition.csv')
+    parser.add_argument('--resolution', type=float, default=0.1, help="step between swept slider values")
+    args = parser.parse_args()
+
+    index, counts, totals = open_store(ensure_store(args.path))
+    cube = ScenarioCube(index['combinations'], index['years'], index['genders'], index['age_groups'], counts, totals)
+    results = sweep(cube, sweep_values(-5, 5, args.resolution), sweep_values(-5, 4, args.resolution),
+                    metrics=MONOTONE_METRICS, end_year=min(int(cube.years[-1]), 2100))
+    failures = non_monotone(results)
+    for name, axis in failures:
+        print(f"Not monotone: {name} along {axis}")
+    if failures:
+        sys.exit(1)
+    print("All metrics are monotone along every axis")
+
+
+if __name__ == "__main__":
+    # python -m utils.sensitivity [path/to/population_composition.csv] [--resolution 0.1]
+    main()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.schema import POPULATION_SCHEMA, apply_schema, sorted_age_groups
+
+SOURCE_METADATA_KEY = b'population_source'
+STORE_FILES = ['index.json', 'counts.npy', 'totals.npy']
+# Bumped when the store layout changes, so stores built by older code are rebuilt
+STORE_VERSION = 2
+
+
+def columnar_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_signature(csv_path):
+    stat = os.stat(csv_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_hash(csv_path)}
+
+
+def read_csv(csv_path):
+    return apply_schema(pd.read_csv(csv_path, dtype=POPULATION_SCHEMA))
+
+
+def write_columnar(df, parquet_path, signature):
+    write_signed_table(pa.Table.from_pandas(df, preserve_index=False), parquet_path, signature)
+
+
+def write_signed_table(table, parquet_path, signature):
+    # Record which CSV the file was built from so stale copies can be detected
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_METADATA_KEY] = json.dumps(signature).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # Write next to the target and swap it in, so readers never see a partial file
+    tmp_path = f"{parquet_path}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, parquet_path)
+
+
+def stored_signature(parquet_path):
+    metadata = pq.read_schema(parquet_path).metadata or {}
+    if SOURCE_METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[SOURCE_METADATA_KEY])
+
+
+def is_fresh(parquet_path, csv_path):
+    if not os.path.exists(parquet_path):
+        return False
+    stored = stored_signature(parquet_path)
+    if not signature_matches(stored, csv_path):
+        return False
+    if is_touched(stored, csv_path):
+        try:
+            write_signed_table(pq.read_table(parquet_path), parquet_path, restamped(stored, csv_path))
+        except OSError:
+            pass
+    return True
+
+
+def signature_matches(stored, csv_path):
+    if stored is None:
+        return False
+
+    stat = os.stat(csv_path)
+    if stored['mtime_ns'] == stat.st_mtime_ns and stored['size'] == stat.st_size:
+        return True
+
+    # A touched but unchanged CSV should not force a rebuild
+    return stored['size'] == stat.st_size and stored['sha256'] == file_hash(csv_path)
+
+
+def is_touched(stored, csv_path):
+    # Matched by hash rather than by mtime: the next check would hash the whole file again
+    return stored['mtime_ns'] != os.stat(csv_path).st_mtime_ns
+
+
+def restamped(stored, csv_path):
+    # The unchanged content's signature with the file's new mtime, so later checks skip the hash
+    return dict(stored, mtime_ns=os.stat(csv_path).st_mtime_ns)
+
+
+def convert_to_columnar(csv_path):
+    parquet_path = columnar_path(csv_path)
+    df = read_csv(csv_path)
+    write_columnar(df, parquet_path, source_signature(csv_path))
+    return df
+
+
+def read_population(csv_path):
+    # Prefer the columnar copy, fall back to (and rebuild from) the CSV when it is missing or stale
+    parquet_path = columnar_path(csv_path)
+    if not os.path.exists(csv_path) or is_fresh(parquet_path, csv_path):
+        return apply_schema(pd.read_parquet(parquet_path))
+
+    df = read_csv(csv_path)
+    try:
+        write_columnar(df, parquet_path, source_signature(csv_path))
+    except OSError:
+        # Read-only deployments can still serve straight from the CSV
+        pass
+    return df
+
+
+def store_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.store'
+
+
+def build_store(csv_path, chunksize=1_000_000):
+    # Stream the CSV twice so the full frame never has to fit in memory:
+    # once to collect the axis labels, once to scatter counts into a memory-mapped cube
+    combinations, years, genders, age_groups = {}, set(), set(), set()
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=POPULATION_SCHEMA):
+        combinations.update(dict.fromkeys(chunk['Combination'].unique().tolist()))
+        years.update(chunk['Year'].unique().tolist())
+        genders.update(chunk['Gender'].unique().tolist())
+        age_groups.update(chunk['AgeGroup'].unique().tolist())
+
+    index = {
+        'combinations': list(combinations),
+        'years': [int(year) for year in sorted(years)],
+        'genders': sorted(genders),
+        'age_groups': sorted_age_groups(sorted(age_groups)),
+    }
+    axes = [pd.Index(index[name]) for name in ('combinations', 'years', 'genders', 'age_groups')]
+
+    def fill(counts):
+        # Counts are summed at full precision here; only the in-memory frame is float32
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={**POPULATION_SCHEMA, 'Count': np.float64}):
+            codes = tuple(axis.get_indexer(chunk[column])
+                          for axis, column in zip(axes, ('Combination', 'Year', 'Gender', 'AgeGroup')))
+            np.add.at(counts, codes, chunk['Count'].to_numpy(dtype=np.float64))
+
+    return write_store(store_path(csv_path), index, fill, source_signature(csv_path), chunksize)
+
+
+def write_store(target, index, fill, source=None, chunksize=1_000_000):
+    # fill(counts) writes every scenario into the zeroed, memory-mapped (combination, year, gender, age) cube
+    tmp_dir = f"{target}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        # Combination is the leading axis, so each scenario is one contiguous run of pages
+        shape = tuple(len(index[name]) for name in ('combinations', 'years', 'genders', 'age_groups'))
+        counts = np.lib.format.open_memmap(os.path.join(tmp_dir, 'counts.npy'), mode='w+', dtype=np.float64,
+                                           shape=shape)
+        fill(counts)
+        counts.flush()
+
+        # Yearly totals per combination, summed a block of scenarios at a time to bound memory
+        totals = np.empty(counts.shape[:2])
+        block = max(1, chunksize // max(1, counts[0].size))
+        for start in range(0, len(totals), block):
+            totals[start:start + block] = counts[start:start + block].sum(axis=(2, 3))
+        np.save(os.path.join(tmp_dir, 'totals.npy'), totals)
+        del counts
+
+        index = dict(index, version=STORE_VERSION)
+        if source is not None:
+            index['source'] = source
+        write_store_index(tmp_dir, index)
+
+        # Swap the finished store in; processes that still map the old files keep their pages
+        if os.path.exists(target):
+            old_dir = f"{target}.old-{os.getpid()}"
+            os.replace(target, old_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return target
+
+
+def read_store_index(store_dir):
+    with open(os.path.join(store_dir, 'index.json')) as file:
+        return json.load(file)
+
+
+def write_store_index(store_dir, index):
+    # Swapped in whole, so readers never see a partial index
+    tmp_path = os.path.join(store_dir, f'index.json.tmp-{os.getpid()}')
+    with open(tmp_path, 'w') as file:
+        json.dump(index, file)
+    os.replace(tmp_path, os.path.join(store_dir, 'index.json'))
+
+
+def ensure_store(csv_path):
+    target = store_path(csv_path)
+    if os.path.exists(csv_path):
+        complete = all(os.path.exists(os.path.join(target, name)) for name in STORE_FILES)
+        index = read_store_index(target) if complete else {}
+        if (not complete or index.get('version') != STORE_VERSION
+                or not signature_matches(index.get('source'), csv_path)):
+            build_store(csv_path)
+        elif is_touched(index['source'], csv_path):
+            try:
+                write_store_index(target, dict(index, source=restamped(index['source'], csv_path)))
+            except OSError:
+                pass
+    return target
+
+
+def open_store(store_dir):
+    # Read-only memory maps: pages load on first touch and are shared by every session and process
+    index = read_store_index(store_dir)
+    counts = np.load(os.path.join(store_dir, 'counts.npy'), mmap_mode='r')
+    totals = np.load(os.path.join(store_dir, 'totals.npy'), mmap_mode='r')
+    return index, counts, totals
+
+
+if __name__ == "__main__":
+    # One-time conversion: python -m utils.storage [path/to/population_composition.csv]
+    source = sys.argv[1] if len(sys.argv) > 1 else "data/population_composition.csv"
+    convert_to_columnar(source)
+    print(f"Wrote {columnar_path(source)}")
+    build_store(source)
+    print(f"Wrote {store_path(source)}")
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.data_processing import get_combination
+from utils.projection import CohortComponentModel
+from utils.schema import sorted_age_groups
+from utils.storage import SOURCE_METADATA_KEY, columnar_path, source_signature, store_path, write_store
+
+FORMATS = ('csv', 'parquet', 'store')
+# Grid steps that keep combination names short decimals, finest last
+GRID_STEPS = (1, 0.5, 0.25, 0.2, 0.1, 0.05, 0.04, 0.02, 0.01, 0.005, 0.004, 0.002, 0.001)
+MORTALITY_RANGE = (-5, 5)
+FERTILITY_RANGE = (-5, 4)
+NAMED_SCENARIOS = ['Vision 2030', 'High Growth', 'Low Growth', 'Ageing Society', 'Return Migration']
+# Scenarios generated and written together
+BLOCK_SIZE = 2000
+
+# Fixed types, so every row group of a large parquet file has the same schema
+PARQUET_SCHEMA = pa.schema([
+    ('Combination', pa.dictionary(pa.int32(), pa.string())),
+    ('Year', pa.uint16()),
+    ('Gender', pa.dictionary(pa.int8(), pa.string())),
+    ('AgeGroup', pa.dictionary(pa.int16(), pa.string())),
+    ('Count', pa.float32()),
+])
+
+
+def age_group_labels(width=5, max_age=80):
+    # '0-4', '5-9', ..., '80+' in the data's style; single years are labelled '0', '1', ...
+    lowers = range(0, max_age, width)
+    labels = [str(lower) if width == 1 else f"{lower}-{lower + width - 1}" for lower in lowers]
+    return labels + [f"{max_age}+"]
+
+
+def scenario_settings(combinations, named=1, seed=0):
+    # Slider grid points closest to the baseline first, on the coarsest grid that has enough of them;
+    # named scenarios get random settings within the slider ranges
+    slider_count = combinations - min(named, combinations - 1)
+    for step in GRID_STEPS:
+        asmr = np.round(np.arange(MORTALITY_RANGE[0], MORTALITY_RANGE[1] + step / 2, step), 6)
+        asfr = np.round(np.arange(FERTILITY_RANGE[0], FERTILITY_RANGE[1] + step / 2, step), 6)
+        if len(asmr) * len(asfr) >= slider_count:
+            break
+    else:
+        raise ValueError(f"At most {len(asmr) * len(asfr)} slider combinations fit the grid")
+
+    asmr, asfr = (axis.ravel() for axis in np.meshgrid(asmr, asfr, indexing='ij'))
+    order = np.lexsort((asfr, asmr, np.abs(asmr) + np.abs(asfr)))[:slider_count]
+    names = [get_combination(a, f) for a, f in zip(asmr[order], asfr[order])]
+    settings = np.column_stack([asmr[order], asfr[order]])
+
+    named_count = combinations - slider_count
+    names += (NAMED_SCENARIOS + [f"Scenario {i}" for i in range(len(NAMED_SCENARIOS) + 1, named_count + 1)])[:named_count]
+    rng = np.random.default_rng(seed)
+    random_settings = np.column_stack([rng.uniform(*MORTALITY_RANGE, named_count),
+                                       rng.uniform(*FERTILITY_RANGE, named_count)])
+    return names, np.vstack([settings, random_settings])
+
+
+def synthetic_model(years, width=5, max_age=80):
+    # A plausible population: counts fall with age, women aged 15-49 have about 1.8 children,
+    # and mortality rises steeply in old age
+    labels = age_group_labels(width, max_age)
+    lowers = np.arange(0, max_age + 1, width)
+    widths = np.full(len(labels), float(width))
+    base = 10_000 * widths * np.exp(-0.02 * lowers)
+    base_population = np.vstack([base * 0.99, base])
+    annual_death = 0.0005 + 0.00003 * np.exp(0.09 * lowers)
+    survival = np.vstack([1 - annual_death * 0.85, 1 - annual_death])
+    survival = np.clip(survival, 0.0, 1.0)
+    fertility = np.where((lowers >= 15) & (lowers < 50), 1.8 / 35, 0.0)
+    model = CohortComponentModel(np.asarray(years), base_population, survival, fertility, np.array([0.488, 0.512]),
+                                 widths, 0, np.arange(len(labels)), mortality_step=0.1, fertility_step=0.1)
+    return model, labels
+
+
+def scenario_blocks(combinations, years, width, max_age, named, seed, block_size=BLOCK_SIZE):
+    # (names, counts) per block of scenarios, counts shaped (scenario, year, gender, age);
+    # the same arguments always give the same data
+    names, settings = scenario_settings(combinations, named, seed)
+    model, _ = synthetic_model(years, width, max_age)
+    rng = np.random.default_rng(seed)
+    for start in range(0, combinations, block_size):
+        block = settings[start:start + block_size]
+        counts = model.project(block[:, 0], block[:, 1])
+        # A little noise, so scenarios are not exact functions of their settings
+        counts *= rng.normal(1.0, 0.002, counts.shape)
+        yield names[start:start + block_size], counts
+
+
+def block_frame(names, counts, years, labels):
+    c, y, g, a = np.indices(counts.shape).reshape(4, -1)
+    return pd.DataFrame({
+        'Combination': pd.Categorical.from_codes(c, categories=names),
+        'Year': np.asarray(years, dtype=np.uint16)[y],
+        'Gender': pd.Categorical.from_codes(g, categories=['F', 'M']),
+        'AgeGroup': pd.Categorical.from_codes(a, categories=labels),
+        'Count': counts.ravel().astype(np.float32),
+    })
+
+
+def generate(csv_path, combinations=111, years=range(2024, 2101), age_width=5, max_age=80, named=1,
+             formats=FORMATS, seed=0):
+    # Writes the dataset in each requested format, a block of scenarios at a time, so a million
+    # combinations never have to be in memory at once. Returns the paths written.
+    years = list(years)
+    labels = age_group_labels(age_width, max_age)
+    written = []
+
+    def blocks():
+        return scenario_blocks(combinations, years, age_width, max_age, named, seed)
+
+    source = None
+
+    if 'csv' in formats:
+        tmp_path = f"{csv_path}.tmp"
+        for i, (names, counts) in enumerate(blocks()):
+            block_frame(names, counts, years, labels).to_csv(tmp_path, mode='w' if i == 0 else 'a',
+                                                            header=i == 0, index=False)
+        os.replace(tmp_path, csv_path)
+        source = source_signature(csv_path)
+        written.append(csv_path)
+
+    if 'parquet' in formats:
+        parquet_path = columnar_path(csv_path)
+        schema = PARQUET_SCHEMA
+        if source is not None:
+            # Tie the copy to the CSV, as storage.write_columnar does
+            schema = schema.with_metadata({SOURCE_METADATA_KEY: json.dumps(source).encode()})
+        tmp_path = f"{parquet_path}.tmp"
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for names, counts in blocks():
+                table = pa.Table.from_pandas(block_frame(names, counts, years, labels), preserve_index=False)
+                writer.write_table(table.cast(PARQUET_SCHEMA).replace_schema_metadata(schema.metadata))
+        os.replace(tmp_path, parquet_path)
+        written.append(parquet_path)
+
+    if 'store' in formats:
+        index = {
+            'combinations': scenario_settings(combinations, named, seed)[0],
+            'years': [int(year) for year in years],
+            'genders': ['F', 'M'],
+            'age_groups': sorted_age_groups(labels),
+        }
+
+        def fill(store_counts):
+            start = 0
+            for names, counts in blocks():
+                store_counts[start:start + len(names)] = counts
+                start += len(names)
+
+        written.append(write_store(store_path(csv_path), index, fill, source))
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic scenario dataset in the app's formats.")
+    parser.add_argument('path', help="CSV path; the parquet copy and the store are written next to it")
+    parser.add_argument('--combinations', type=int, default=111)
+    parser.add_argument('--first-year', type=int, default=2024)
+    parser.add_argument('--last-year', type=int, default=2100)
+    parser.add_argument('--age-width', type=int, default=5, help="years per age group; 1 for single years")
+    parser.add_argument('--max-age', type=int, default=80, help="lower bound of the open-ended oldest group")
+    parser.add_argument('--named', type=int, default=1, help="named scenarios among the combinations")
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path in generate(args.path, args.combinations, range(args.first_year, args.last_year + 1), args.age_width,
+                         args.max_age, args.named, args.formats, args.seed):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    # python -m utils.synthetic /tmp/large.csv --combinations 1000000 --formats parquet store
+    main()
@@ -1,28 +1,43 @@
+import functools
 import pandas as pd
 import streamlit as st
-from utils.data_processing import load_data, filter_data, get_combination
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from utils.data_processing import load_cube, filter_data, get_combination, data_file_key
+from utils.sensitivity import run_sweep, sweep_values
+from utils.replications import simulate_uncertainty
 from components.custom_components import sidebar_custom_slider, custom_sidebar_button
 from components.chatgpt_dialog import show_ui
-from views.scenario_comparison import show_comparison_mode
+from views.scenario_comparison import show_comparison_mode, MAX_SCENARIOS
 from utils.plots import plot_population_projection, plot_population_composition
+from utils.figure_cache import figure_key, get_figure_cache
+from utils.prewarm import get_prewarmer
+from utils.instrumentation import plotly_chart
 import plotly.graph_objects as go
 import numpy as np
 
+MORTALITY_RANGE = (-5.0, 5.0)
+FERTILITY_RANGE = (-5.0, 4.0)
+# Whole steps hit the precomputed grid; the half steps in between are projected from rates
+SLIDER_STEP = 0.5
+MIGRATION_RANGE = (-10.0, 10.0)
+# Sensitivity grid steps; anything finer than 1 is projected between the data's scenarios
+SENSITIVITY_RESOLUTIONS = [1.0, 0.5, 0.25, 0.1, 0.05]
+
 
 def show():
     st.title('Population Microsimulation')
 
     # Load data
-    df = load_data()
+    cube = load_cube()
 
     # Create tabs
     tab1, tab2 = st.tabs(["Scenario Analysis", "Sensitivity Analysis"])
 
     with tab1:
-        show_scenario_analysis(df)
+        show_scenario_analysis(cube)
 
     with tab2:
-        show_sensitivity_analysis(df)
+        show_sensitivity_analysis(cube)
 
     # Custom sidebar back button (outside of tabs)
     if custom_sidebar_button("Back to Home Page", "sidebar_back_button"):
@@ -30,7 +45,7 @@ def show():
         st.rerun()
 
 
-def show_scenario_analysis(df):
+def show_scenario_analysis(cube):
 
     # Toggle for comparison mode
     comparison_mode = st.sidebar.checkbox("Enable Scenario Comparison")
@@ -47,49 +62,48 @@ def show_scenario_analysis(df):
     if comparison_mode:
         st.markdown('### Scenario Comparison Mode')
         st.sidebar.markdown('# Instruments')
-        # Scenario 1
-        st.sidebar.markdown("### Scenario 1")
-        combinations = df['Combination'].unique()
+        combinations = cube.combinations
         other_combinations = [c for c in combinations if not (c.startswith('asmr'))]
-        selected_combination1 = st.sidebar.selectbox('Select a specific scenario', ['None'] + other_combinations, key='scenario1')
-
-        asmr1 = sidebar_custom_slider('Mortality', -5, 5, 0, 'asmr1', 'Low', 'High')
-        asfr1 = sidebar_custom_slider('Fertility', -5, 4, 0, 'asfr1', 'Low', 'High')
-        slider_combination1 = get_combination(asmr1, asfr1)
-
-        combination1 = selected_combination1 if selected_combination1 != 'None' else slider_combination1
-        st.sidebar.markdown("---")
+        scenario_count = st.sidebar.number_input("Scenarios to compare", 2, MAX_SCENARIOS, 2)
 
-        # Scenario 2
-        st.sidebar.markdown("### Scenario 2")
-        selected_combination2 = st.sidebar.selectbox('Select a specific scenario', ['None'] + other_combinations, key='scenario2')
+        compared = []
+        for n in range(1, scenario_count + 1):
+            st.sidebar.markdown(f"### Scenario {n}")
+            selected_combination = st.sidebar.selectbox('Select a specific scenario', ['None'] + other_combinations, key=f'scenario{n}')
 
-        asmr2 = sidebar_custom_slider('Mortality', -5, 5, 0, 'asmr2', 'Low', 'High')
-        asfr2 = sidebar_custom_slider('Fertility', -5, 4, 0, 'asfr2', 'Low', 'High')
-        slider_combination2 = get_combination(asmr2, asfr2)
+            asmr = sidebar_custom_slider('Mortality', *MORTALITY_RANGE, 0.0, f'asmr{n}', 'Low', 'High', step=SLIDER_STEP)
+            asfr = sidebar_custom_slider('Fertility', *FERTILITY_RANGE, 0.0, f'asfr{n}', 'Low', 'High', step=SLIDER_STEP)
+            slider_combination = get_combination(asmr, asfr)
 
-        combination2 = selected_combination2 if selected_combination2 != 'None' else slider_combination2
-        st.sidebar.markdown("---")
+            compared.append(selected_combination if selected_combination != 'None' else slider_combination)
+            st.sidebar.markdown("---")
 
-        show_comparison_mode(df, combination1, combination2)
+        show_comparison_mode(cube, compared)
     else:
         # Sidebar for user inputs and ChatGPT dialog
         st.sidebar.markdown('# Instruments')
-        combinations = df['Combination'].unique()
+        combinations = cube.combinations
         other_combinations = [c for c in combinations if not (c.startswith('asmr'))]
 
         # Scenarios dropdown
         selected_combination = st.sidebar.selectbox('Select a specific scenario', ['None'] + other_combinations)
 
         # Sliders for ASMR and ASFR
-        asmr = sidebar_custom_slider('Mortality', -5, 5, 0, 'asmr', 'Low', 'High')
-        asfr = sidebar_custom_slider('Fertility', -5, 4, 0, 'asfr', 'Low', 'High')
+        asmr = sidebar_custom_slider('Mortality', *MORTALITY_RANGE, 0.0, 'asmr', 'Low', 'High', step=SLIDER_STEP)
+        asfr = sidebar_custom_slider('Fertility', *FERTILITY_RANGE, 0.0, 'asfr', 'Low', 'High', step=SLIDER_STEP)
         slider_combination = get_combination(asmr, asfr)
 
         # Determine which combination to use
         combination = selected_combination if selected_combination != 'None' else slider_combination
 
-        show_single_mode(df, combination, True)
+        # Monte Carlo bands only exist for slider scenarios
+        show_uncertainty = selected_combination == 'None' and st.sidebar.checkbox("Show uncertainty bands")
+
+        show_single_mode(cube, combination, True, show_uncertainty)
+
+        # Build the figures one slider step away while the user looks at this one
+        if selected_combination == 'None':
+            prewarm_slider_neighbours(cube, asmr, asfr, True)
 
         # Add ChatGPT Dialog to sidebar only in single mode
         st.sidebar.markdown("---")
@@ -98,30 +112,30 @@ def show_scenario_analysis(df):
         st.sidebar.markdown("---")
 
 
-def show_sensitivity_analysis(df):
-    # Generate all combinations of ASMR and ASFR
-    asmr_values = range(-5, 6)
-    asfr_values = range(-5, 5)
-
-    # Create empty matrix to store results
-    results = np.zeros((len(asmr_values), len(asfr_values)))
-
-    # Perform analysis
-    for i, asmr in enumerate(asmr_values):
-        for j, asfr in enumerate(asfr_values):
-            combination = get_combination(asmr, asfr)
-            filtered_df = filter_data(df, combination)
-
-            # Calculate a metric (e.g., total population in 2100)
-            metric = filtered_df[filtered_df['Year'] == 2100]['Count'].sum() * 190
-
-            results[i, j] = metric
+def show_sensitivity_analysis(cube):
+    # Resolution of the ASMR x ASFR grid; whole steps are the scenarios in the data
+    col1, col2 = st.columns(2)
+    with col1:
+        resolution = st.select_slider("Grid resolution", options=SENSITIVITY_RESOLUTIONS, value=1.0,
+                                      format_func=lambda step: f"{step:g}")
+    with col2:
+        migration = st.slider("Net migration (per 1,000 a year)", *MIGRATION_RANGE, 0.0, step=0.5)
+
+    data_key = data_file_key()
+    sweep = run_sweep(data_key, sweep_values(*MORTALITY_RANGE, resolution),
+                      sweep_values(*FERTILITY_RANGE, resolution), (migration,),
+                      ('final_population', 'impact', 'volatility'))
+    asmr_values = sweep['axes']['asmr']
+    asfr_values = sweep['axes']['asfr']
+    results = sweep['final_population'][:, :, 0]
+    whole_asmr = list(range(int(MORTALITY_RANGE[0]), int(MORTALITY_RANGE[1]) + 1))
+    whole_asfr = list(range(int(FERTILITY_RANGE[0]), int(FERTILITY_RANGE[1]) + 1))
 
     # Create heatmap
     fig = go.Figure(data=go.Heatmap(
         z=results,
-        x=list(asfr_values),
-        y=list(asmr_values),
+        x=asfr_values,
+        y=asmr_values,
         colorscale='Viridis',
         colorbar=dict(
             titleside='right',
@@ -139,15 +153,15 @@ def show_sensitivity_analysis(df):
         margin=dict(t=20, b=20, l=70, r=20),  # Adjust top margin
         xaxis=dict(
             tickmode='array',
-            tickvals=list(asfr_values),
-            ticktext=list(asfr_values),
+            tickvals=whole_asfr,
+            ticktext=whole_asfr,
             tickfont=dict(size=18)
 
         ),
         yaxis=dict(
             tickmode='array',
-            tickvals=list(asmr_values),
-            ticktext=list(asmr_values),
+            tickvals=whole_asmr,
+            ticktext=whole_asmr,
             tickfont=dict(size=18)
 
         )
@@ -155,7 +169,7 @@ def show_sensitivity_analysis(df):
 
     st.markdown("## Sensitivity Analysis: Population in 2100")
     # Display the chart
-    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+    plotly_chart('sensitivity_heatmap', fig, use_container_width=True, config={'displayModeBar': False})
 
     # Additional insights
     st.write("### Key Insights:")
@@ -164,8 +178,8 @@ def show_sensitivity_analysis(df):
     min_index = np.unravel_index(results.argmin(), results.shape)
 
     st.write(f"1. **Population Range**: The projected population in 2100 ranges from a minimum of {results.min():,.0f} "
-             f"(Mortality = {asmr_values[min_index[0]]}, Fertility = {asfr_values[min_index[1]]}) to a maximum of {results.max():,.0f} "
-             f"(Mortality = {asmr_values[max_index[0]]}, Fertility = {asfr_values[max_index[1]]}).")
+             f"(Mortality = {asmr_values[min_index[0]]:g}, Fertility = {asfr_values[min_index[1]]:g}) to a maximum of {results.max():,.0f} "
+             f"(Mortality = {asmr_values[max_index[0]]:g}, Fertility = {asfr_values[max_index[1]]:g}).")
 
     st.write(f"2. **Sensitivity**: The population projection is most sensitive to changes in fertility rates, "
              f"as indicated by the more dramatic color changes along the horizontal axis. Mortality rates "
@@ -175,44 +189,15 @@ def show_sensitivity_analysis(df):
 
     st.markdown("## Sensitivity Analysis: Policy Impact vs Population Volatility")
 
-    # Generate all combinations of ASMR and ASFR
-    asmr_values = range(-5, 6)
-    asfr_values = range(-5, 5)
-
-    # Calculate baseline (no change scenario)
-    baseline_combination = get_combination(0, 0)
-    baseline_df = filter_data(df, baseline_combination)
-    baseline_population_2100 = baseline_df[baseline_df['Year'] == 2100]['Count'].sum() * 190
-
-    res = []
-
-    for i, asmr in enumerate(asmr_values):
-        for j, asfr in enumerate(asfr_values):
-            combination = get_combination(asmr, asfr)
-            filtered_df = filter_data(df, combination)
-
-            # Calculate population for each year
-            yearly_populations = [filtered_df[filtered_df['Year'] == year]['Count'].sum() * 190 for year in
-                                  range(2024, 2101)]
-
-            # Calculate final impact
-            final_population = yearly_populations[-1]
-            impact = (final_population - baseline_population_2100) / baseline_population_2100
-            # impact_matrix[i, j] = impact
-
-            # Calculate volatility (standard deviation of year-over-year changes)
-            yoy_changes = [(yearly_populations[i] - yearly_populations[i - 1]) / yearly_populations[i - 1] for i in
-                           range(1, len(yearly_populations))]
-            volatility = np.std(yoy_changes)
-            # volatility_matrix[i, j] = volatility
-            res.append({
-                "ASMR": asmr,
-                "ASFR": asfr,
-                "impact": impact,
-                "volatility": volatility,
-                "strength":-asmr + asfr
-            })
-    odf = pd.DataFrame(res)
+    # Policy grid laid out to match the (asmr, asfr) axes of the sensitivity results
+    asmr_grid, asfr_grid = np.meshgrid(asmr_values, asfr_values, indexing='ij')
+    odf = pd.DataFrame({
+        "ASMR": asmr_grid.ravel(),
+        "ASFR": asfr_grid.ravel(),
+        "impact": sweep['impact'].ravel(),
+        "volatility": sweep['volatility'].ravel(),
+        "strength": (-asmr_grid + asfr_grid).ravel()
+    })
     # Create the scatter plot
     fig = go.Figure()
 
@@ -236,8 +221,9 @@ def show_sensitivity_analysis(df):
             ),
             showscale=True
         ),
-        hovertext="ASMR: " + odf['ASMR'].astype(str) + ", ASFR: " + odf['ASFR'].astype(str),  # Passing a DataFrame column as hover text
-        hoverinfo='text'
+        # The browser formats the hover text, so only the numbers are sent
+        customdata=odf[['ASMR', 'ASFR']].to_numpy(),
+        hovertemplate="ASMR: %{customdata[0]:g}, ASFR: %{customdata[1]:g}<extra></extra>"
     ))
 
     fig.update_layout(
@@ -259,7 +245,7 @@ def show_sensitivity_analysis(df):
         )
     )
 
-    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+    plotly_chart('sensitivity_scatter', fig, use_container_width=True, config={'displayModeBar': False})
 
     st.markdown("""
     ### Key Insights:
@@ -276,29 +262,89 @@ def show_sensitivity_analysis(df):
     """)
 
 
-def show_single_mode(df, combination, show_base_projection):
-    filtered_df = filter_data(df, combination)
+def single_mode_key(combination, year, show_base_projection, show_uncertainty=False):
+    # Cache key for a chart in show_single_mode: the projection when year is None,
+    # otherwise the pyramid for that year
+    if year is None:
+        variant = (show_base_projection, 'uncertainty') if show_uncertainty else show_base_projection
+        return figure_key('projection', combination, variant=variant)
+    return figure_key('composition', combination, year)
+
+
+def single_mode_builder(load_scenario, year, show_base_projection, show_uncertainty=False):
+    # Builder for the same chart; load_scenario() is only called once the chart is actually built
+    if year is None:
+        if show_uncertainty:
+            def build():
+                scenario = load_scenario()
+                return plot_population_projection(scenario, show_base_projection, uncertainty=uncertainty_for(scenario))
+            return build
+        return lambda: plot_population_projection(load_scenario(), show_base_projection)
+    return lambda: plot_population_composition(load_scenario(), year, title=f"Population Composition at {year}")
+
+
+def single_mode_figure(scenario, year, show_base_projection, show_uncertainty=False):
+    return (single_mode_key(scenario.combination, year, show_base_projection, show_uncertainty),
+            single_mode_builder(lambda: scenario, year, show_base_projection, show_uncertainty))
+
+
+def uncertainty_for(scenario):
+    # Replications run on the process pool, and only when the figure itself is not cached
+    status = st.empty()
+    uncertainty = simulate_uncertainty(
+        data_file_key(), scenario.combination,
+        progress=lambda done, total: status.progress(done / total, f"Simulating replication {done} of {total}"))
+    status.empty()
+    return uncertainty
+
+
+def prewarm_slider_neighbours(cube, asmr, asfr, show_base_projection):
+    # Keys come from the combination alone, so cached neighbours cost nothing here; the scenario
+    # itself, a full projection off the data's grid, is made on the prewarm pool and shared by its charts
+    cache = get_figure_cache()
+    jobs = []
+    neighbours = ((asmr - SLIDER_STEP, asfr), (asmr + SLIDER_STEP, asfr), (asmr, asfr - SLIDER_STEP), (asmr, asfr + SLIDER_STEP))
+    for neighbour_asmr, neighbour_asfr in neighbours:
+        if not (MORTALITY_RANGE[0] <= neighbour_asmr <= MORTALITY_RANGE[1]
+                and FERTILITY_RANGE[0] <= neighbour_asfr <= FERTILITY_RANGE[1]):
+            continue
+        combination = get_combination(neighbour_asmr, neighbour_asfr)
+        keys = [(single_mode_key(combination, year, show_base_projection), year) for year in (None, 2024, 2100)]
+        keys = [(key, year) for key, year in keys if key not in cache]
+        if not keys:
+            continue
+        load_scenario = functools.cache(lambda combination=combination: filter_data(cube, combination))
+        jobs.extend((key, single_mode_builder(load_scenario, year, show_base_projection)) for key, year in keys)
+
+    # Submitted even when empty: it also drops what this session still had queued for older neighbours
+    ctx = get_script_run_ctx()
+    owner = ctx.session_id if ctx else None
+    get_prewarmer().submit(owner, cache, jobs)
+
+
+def show_single_mode(cube, combination, show_base_projection, show_uncertainty=False):
+    scenario = filter_data(cube, combination)
 
     # Display charts in main area
-    if 'generated_df' in st.session_state:
-        st.plotly_chart(plot_population_projection(st.session_state.generated_df, show_base_projection, is_generated=True),
-                        use_container_width=True, config={'displayModeBar': False})
+    if 'generated_projection' in st.session_state:
+        generated_fig = plot_population_projection(st.session_state.generated_projection, show_base_projection, is_generated=True)
+        plotly_chart('generated_projection', generated_fig, use_container_width=True, config={'displayModeBar': False})
     else:
-        st.plotly_chart(plot_population_projection(filtered_df, show_base_projection),
-                        use_container_width=True, config={'displayModeBar': False})
+        projection_fig = get_figure_cache().get_or_build(*single_mode_figure(scenario, None, show_base_projection, show_uncertainty))
+        plotly_chart('projection', projection_fig, use_container_width=True, config={'displayModeBar': False})
 
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
 
-    if 'generated_df' not in st.session_state:
+    if 'generated_projection' not in st.session_state:
         col1, col_divider, col2 = st.columns([10, 1, 10])
 
         with col1:
-            st.plotly_chart(plot_population_composition(filtered_df, 2024, title=f"Population Composition at 2024"), use_container_width=True,
-                            config={'displayModeBar': False})
+            composition_fig = get_figure_cache().get_or_build(*single_mode_figure(scenario, 2024, show_base_projection))
+            plotly_chart('composition_2024', composition_fig, use_container_width=True, config={'displayModeBar': False})
 
         with col_divider:
             st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
 
         with col2:
-            st.plotly_chart(plot_population_composition(filtered_df, 2100, title=f"Population Composition at 2100"), use_container_width=True,
-                            config={'displayModeBar': False})
\ No newline at end of file
+            composition_fig = get_figure_cache().get_or_build(*single_mode_figure(scenario, 2100, show_base_projection))
+            plotly_chart('composition_2100', composition_fig, use_container_width=True, config={'displayModeBar': False})
\ No newline at end of file
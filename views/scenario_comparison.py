@@ -1,75 +1,83 @@
 import streamlit as st
-from utils.data_processing import filter_data, get_combination
-from utils.plots import plot_population_projection, plot_population_composition
-
-
-def show_comparison_mode(df, combination1, combination2):
-    # st.subheader("Scenario Comparison")
-    
-    # Get data for both scenarios
-    filtered_df1 = filter_data(df, combination1)
-    
-    filtered_df2 = filter_data(df, combination2)
-    
-    # Create the base figure using the imported function
-    fig = plot_population_projection(filtered_df1, False)
-    
-    # Modify the existing trace for Scenario 1
-    fig.data[0].update(
-        name=f"Scenario 1",
-        line=dict(color='#00FFFF', width=2),  # Vibrant cyan
-        showlegend=True
-    )
-    
-    # Add a new trace for Scenario 2
-    fig.add_trace(
-        plot_population_projection(filtered_df2, False).data[0]
-    )
-    
-    # Modify the new trace for Scenario 2
-    fig.data[1].update(
-        name=f"Scenario 2",
-        line=dict(color='#FFA500', width=2),  # Warm orange
-        showlegend=True
-    )
-    
+from utils.comparison import compare_scenarios
+from utils.plots import (plot_comparison_projection, plot_population_composition, plot_yearly_difference,
+                         plot_difference_pyramid)
+from utils.figure_cache import cached_figure
+from utils.instrumentation import plotly_chart
+
+# Vibrant cyan and warm orange for the first two scenarios, as before
+SCENARIO_COLORS = ['#00FFFF', '#FFA500', '#FF69B4', '#7CFC00']
+MAX_SCENARIOS = len(SCENARIO_COLORS)
+
+
+def scenario_names(count):
+    return [f"Scenario {i + 1}" for i in range(count)]
+
+
+def style_comparison(fig):
     # Update layout to ensure legend is shown and transparent, with light text
     fig.update_layout(
         showlegend=True,
         legend=dict(
-            # yanchor="top",
-            # y=0.99,
-            # xanchor="left",
-            # x=0.01,
             bgcolor="rgba(0,0,0,0)",  # Transparent background
             bordercolor="rgba(0,0,0,0)",  # Transparent border
             font=dict(color="white")  # White text for visibility on dark background
         ),
-        # margin=dict(t=50, l=50, r=50, b=50),  # Add margins for better spacing
         paper_bgcolor="rgba(0,0,0,0)",  # Transparent background
         plot_bgcolor="rgba(0,0,0,0)",  # Transparent background
         font=dict(color="white")  # White text for all labels
     )
-    
+
     # Update axes for better visibility on dark background
     fig.update_xaxes(gridcolor="gray", zerolinecolor="gray")
     fig.update_yaxes(gridcolor="gray", zerolinecolor="gray")
-    
+    return fig
+
+
+def build_comparison_projection(comparison):
+    names = scenario_names(len(comparison.combinations))
+    return style_comparison(plot_comparison_projection(comparison, names, SCENARIO_COLORS))
+
+
+def build_yearly_difference(comparison, relative):
+    names = scenario_names(len(comparison.combinations))
+    return style_comparison(plot_yearly_difference(comparison, names, SCENARIO_COLORS, relative))
+
+
+def show_comparison_mode(cube, combinations):
+    # One pass over the data for every scenario; the figures below only read from it
+    combinations = tuple(combinations)
+    comparison = compare_scenarios(cube, combinations)
+    names = scenario_names(len(combinations))
+
+    fig = cached_figure('comparison', combinations, lambda: build_comparison_projection(comparison))
+
     # Display the figure
-    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+    plotly_chart('comparison', fig, use_container_width=True, config={'displayModeBar': False})
 
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
 
-    # Population composition charts (unchanged)
+    # Population composition charts
     comp_year = 2100
-    col1, col2 = st.columns(2)
+    for i, col in enumerate(st.columns(len(combinations))):
+        with col:
+            comp_fig = cached_figure('composition', combinations[i],
+                                     lambda: plot_population_composition(comparison.view(i), comp_year, title=f"{names[i]} Population Composition at {comp_year}"),
+                                     year=comp_year, variant=f'scenario{i + 1}')
+            plotly_chart(f'comparison_composition_{i + 1}', comp_fig, use_container_width=True, config={'displayModeBar': False})
+
+    st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
 
-    with col1:
-        # st.subheader(f"Scenario 1 Population Composition")
-        comp_fig1 = plot_population_composition(filtered_df1, comp_year, title=f"Scenario 1 Population Composition at {comp_year}")
-        st.plotly_chart(comp_fig1, use_container_width=True, config={'displayModeBar': False})
+    # Differences from Scenario 1, over time and by age group
+    relative = st.radio("Differences", ["Absolute", "Relative"], horizontal=True, key='comparison_difference') == "Relative"
+    difference_variant = 'relative' if relative else 'absolute'
+    difference_fig = cached_figure('comparison_difference', combinations,
+                                   lambda: build_yearly_difference(comparison, relative), variant=difference_variant)
+    plotly_chart('comparison_difference', difference_fig, use_container_width=True, config={'displayModeBar': False})
 
-    with col2:
-        # st.subheader(f"Scenario 2 Population Composition")
-        comp_fig2 = plot_population_composition(filtered_df2, comp_year, title=f"Scenario 2 Population Composition at {comp_year}")
-        st.plotly_chart(comp_fig2, use_container_width=True, config={'displayModeBar': False})
\ No newline at end of file
+    for i, col in enumerate(st.columns(len(combinations) - 1), start=1):
+        with col:
+            pyramid_fig = cached_figure('difference_pyramid', (combinations[0], combinations[i]),
+                                        lambda: plot_difference_pyramid(comparison, i, comp_year, title=f"{names[i]} vs {names[0]} at {comp_year}", relative=relative),
+                                        year=comp_year, variant=difference_variant)
+            plotly_chart(f'difference_pyramid_{i}', pyramid_fig, use_container_width=True, config={'displayModeBar': False})